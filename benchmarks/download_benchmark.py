@@ -0,0 +1,57 @@
+"""
+Measures cold (empty data directory) and warm (every file cached) download throughput against a local
+directory standing in for the S3 bucket, so it runs without network access. A latency per chunk can be
+added to mimic a remote bucket and show the effect of the number of download threads.
+
+Usage: python benchmarks/download_benchmark.py [objects] [MB per object] [ms latency per chunk]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from bluebikes import download
+
+
+class SlowBucket(download.LocalBucket):
+
+    def __init__(self, root, latency):
+        super().__init__(root)
+        self.latency = latency
+
+    def read(self, key, etag, start=0):
+        for chunk in super().read(key, etag, start):
+            time.sleep(self.latency)
+            yield chunk
+
+
+def generate_bucket(bucket_dir, objects, megabytes):
+    for i in range(objects):
+        with open(os.path.join(bucket_dir, '2024%02d-bluebikes-tripdata.bin' % (i + 1)), 'wb') as f:
+            f.write(os.urandom(megabytes * 1024 * 1024))
+
+
+def timed_download(data_dir, s3_files, bucket, threads):
+    start = time.perf_counter()
+    download.download_files(data_dir, s3_files, bucket, threads)
+    return time.perf_counter() - start
+
+
+def main(objects, megabytes, latency_ms):
+    with tempfile.TemporaryDirectory() as bucket_dir:
+        generate_bucket(bucket_dir, objects, megabytes)
+        bucket = SlowBucket(bucket_dir, latency_ms / 1000)
+        s3_files = download.list_bucket(bucket)
+        total_mb = objects * megabytes
+
+        for threads in [1, 4, download.DOWNLOAD_THREADS]:
+            with tempfile.TemporaryDirectory() as data_dir:
+                cold_seconds = timed_download(data_dir, s3_files, bucket, threads)
+                warm_seconds = timed_download(data_dir, s3_files, bucket, threads)
+            print("%2s threads   cold: %8.1f MB/s   warm: %8.1f files/s" % (
+                threads, total_mb / cold_seconds, objects / warm_seconds))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [32, 4, 5][len(args):]))
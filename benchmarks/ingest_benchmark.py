@@ -0,0 +1,164 @@
+"""
+Measures rows/s and peak RSS of each ingest stage on synthetic trips of every layout, see synthetic_trips.py:
+
+    parse       insert.read_batches over every file
+    bulk_insert insert._bulk_insert of the parsed batches into an in-memory database
+    dump        insert._dump_memory_db_to_file of that database into a new file database
+    end_to_end  main.main(..., insert_only=True) for each insert strategy
+
+Every stage runs in a fresh process so its peak RSS isn't inflated by the previous ones, once for each of
+--csv_parsers. The results are written as JSON, keyed by layout/stage with /arrow appended for the arrow
+parser, and --compare prints the change in rows/s against a previous result file.
+
+Usage: python benchmarks/ingest_benchmark.py [--rows N] [--csv_parsers csv arrow] [--output results.json]
+       [--compare baseline.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_trips
+from bluebikes import insert
+from bluebikes import main as bluebikes_main
+from bluebikes import sources
+from bluebikes import sql
+
+
+def parse_stage(csv_files, csv_parser):
+    rows = 0
+    for source in map(sources.as_source, csv_files):
+        for _, batch in insert.read_batches(source, csv_parser=csv_parser):
+            rows += len(batch)
+    return rows
+
+
+def _parse_to_batches(csv_files, csv_parser):
+    return [(columns, batch) for source in map(sources.as_source, csv_files)
+            for columns, batch in insert.read_batches(source, csv_parser=csv_parser)]
+
+
+def bulk_insert_stage(csv_files, csv_parser):
+    batches = _parse_to_batches(csv_files, csv_parser)
+    memory_conn, cursor = insert._initialize_in_memory_database(0)
+    start = time.perf_counter()
+    rows = sum(insert._bulk_insert(batch, sql.insert_stmt(columns), cursor) for columns, batch in batches)
+    return rows, time.perf_counter() - start
+
+
+def dump_stage(csv_files, csv_parser):
+    memory_conn, cursor = insert._initialize_in_memory_database(0)
+    for columns, batch in _parse_to_batches(csv_files, csv_parser):
+        insert._bulk_insert(batch, sql.insert_stmt(columns), cursor)
+    rows = memory_conn.execute('SELECT COUNT(*) FROM bluebikes').fetchone()[0]
+    with tempfile.TemporaryDirectory() as db_dir:
+        database = os.path.join(db_dir, 'bluebike.sqlite')
+        file_conn = sqlite3.connect(database)
+        file_conn.execute(sql.table_create)
+        file_conn.close()
+        start = time.perf_counter()
+        insert._dump_memory_db_to_file(memory_conn, csv_files, database)
+        return rows, time.perf_counter() - start
+
+
+def end_to_end_stage(csv_files, csv_parser, insert_strategy):
+    data_dir = os.path.dirname(csv_files[0])
+    with tempfile.TemporaryDirectory() as db_dir:
+        # main writes insert.DATABASE relative to the working directory
+        os.chdir(db_dir)
+        start = time.perf_counter()
+        bluebikes_main.main(data_dir, is_cleanup_downloads=False, insert_only=True, insert_strategy=insert_strategy,
+                           csv_parser=csv_parser)
+        seconds = time.perf_counter() - start
+        rows = sqlite3.connect(insert.DATABASE).execute('SELECT COUNT(*) FROM bluebikes').fetchone()[0]
+    return rows, seconds
+
+
+STAGES = {
+    'parse': parse_stage,
+    'bulk_insert': bulk_insert_stage,
+    'dump': dump_stage,
+    'end_to_end_memory': lambda csv_files, csv_parser: end_to_end_stage(csv_files, csv_parser, 'memory'),
+    'end_to_end_stream': lambda csv_files, csv_parser: end_to_end_stage(csv_files, csv_parser, 'stream'),
+}
+
+
+def _run_stage(name, csv_files, csv_parser, results):
+    start = time.perf_counter()
+    result = STAGES[name](csv_files, csv_parser)
+    # stages that need setup time their own measured section
+    rows, seconds = result if isinstance(result, tuple) else (result, time.perf_counter() - start)
+    # ru_maxrss is in kilobytes on linux, children covers the worker processes of the end to end runs
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    results.put({'rows': rows, 'seconds': seconds, 'rows_per_sec': rows / seconds, 'peak_rss_mb': peak_kb / 1024})
+
+
+def run_stage(name, csv_files, csv_parser='csv'):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_stage, args=(name, csv_files, csv_parser, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("The %s stage failed" % name)
+    return results.get()
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit or None, 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'cpu_count': os.cpu_count()}
+
+
+def main(rows, layouts, stages, csv_parsers, output, compare):
+    report = {'environment': environment(), 'rows_per_file': rows, 'results': {}}
+    with tempfile.TemporaryDirectory() as data_dir:
+        for layout in layouts:
+            csv_files = synthetic_trips.write_trip_csvs(os.path.join(data_dir, layout), rows, [layout])
+            for stage in stages:
+                for csv_parser in csv_parsers:
+                    result = run_stage(stage, csv_files, csv_parser)
+                    # csv results keep the keys of earlier result files
+                    key = '%s/%s' % (layout, stage) if csv_parser == 'csv' else '%s/%s/%s' % (layout, stage, csv_parser)
+                    report['results'][key] = result
+                    print("%-4s %-18s %-5s %10.0f rows/s %8.1f MB peak RSS" % (
+                        layout, stage, csv_parser, result['rows_per_sec'], result['peak_rss_mb']), file=sys.stderr)
+
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)['results']
+        for key, result in report['results'].items():
+            if key in baseline:
+                change = result['rows_per_sec'] / baseline[key]['rows_per_sec'] - 1
+                print("%-24s %+7.1f%% rows/s" % (key, change * 100), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the ingest stages on synthetic trip data")
+    parser.add_argument("--rows", type=int, default=200000, help="Rows per synthetic file")
+    parser.add_argument("--layouts", nargs="+", choices=list(synthetic_trips.LAYOUT_MONTHS),
+                        default=list(synthetic_trips.LAYOUT_MONTHS))
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--csv_parsers", nargs="+", choices=insert.CSV_PARSERS, default=['csv'],
+                        help="The CSV parsers to run every stage with")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="A previous JSON result file to compare rows/s against")
+    args = parser.parse_args()
+    main(args.rows, args.layouts, args.stages, args.csv_parsers, args.output, args.compare)
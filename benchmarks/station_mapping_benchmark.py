@@ -0,0 +1,74 @@
+"""
+Times bluebikes.stations.legacy.mapping.match_stations on the station facet export and on a synthetic copy
+of it scaled up N times, where every copy is moved a degree north and its current ids and names get a suffix.
+On the export, the closest stations found with the grid are checked against the distances to every current
+station.
+
+Usage: python benchmarks/station_mapping_benchmark.py [facet csv] [scale]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from bluebikes import distance
+from bluebikes.stations.legacy import mapping
+
+DEFAULT_FACETS = os.path.join(os.path.dirname(__file__), '..', 'examples', 'legacy_station_input.csv')
+
+
+def scale_facets(df, scale):
+    copies = [df]
+    is_legacy = pd.to_numeric(df['station_id'], errors='coerce') < 1000
+    for k in range(1, scale):
+        copy = df.copy()
+        copy['lat'] = copy['lat'] + k
+        copy['station_name'] = copy['station_name'] + ' #%s' % k
+        copy.loc[~is_legacy, 'station_id'] = copy.loc[~is_legacy, 'station_id'] + '-%s' % k
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def scan_closest(df_current, lat, lng):
+    distances = distance.haversine_meters(lat, lng, df_current['lat'].to_numpy(), df_current['lng'].to_numpy())
+    # the first one on ties
+    index = int(np.argmin(distances))
+    return df_current['station_id'].iloc[index], float(distances[index])
+
+
+def compare_with_scan(df):
+    is_legacy = pd.to_numeric(df['station_id'], errors='coerce') < 1000
+    df_current = df[~is_legacy]
+    legacy = list(zip(df[is_legacy]['lat'], df[is_legacy]['lng']))
+
+    start = time.perf_counter()
+    expected = [scan_closest(df_current, lat, lng) for lat, lng in legacy]
+    scan_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = mapping.StationGrid(df_current['station_id'], df_current['lat'], df_current['lng'],
+                               mapping.DEFAULT_MAX_DISTANCE_METERS)
+    actual = [grid.closest(lat, lng) for lat, lng in legacy]
+    grid_seconds = time.perf_counter() - start
+
+    assert actual == [closest if closest[1] <= mapping.DEFAULT_MAX_DISTANCE_METERS else (None, float('inf'))
+                      for closest in expected]
+    print("closest stations  scan: %.3fs   grid: %.3fs   speedup: %.0fx" % (
+        scan_seconds, grid_seconds, scan_seconds / grid_seconds), file=sys.stderr)
+
+
+def main(facets, scale):
+    df = pd.read_csv(facets)
+    compare_with_scan(df)
+    for name, data in [('export', df), ('%sx synthetic' % scale, scale_facets(df, scale))]:
+        legacy_rows = (pd.to_numeric(data['station_id'], errors='coerce') < 1000).sum()
+        start = time.perf_counter()
+        mapping.match_stations(data)
+        seconds = time.perf_counter() - start
+        print("%-14s %7d facets %6d legacy rows %8.3fs" % (name, len(data), legacy_rows, seconds), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FACETS, int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,119 @@
+"""
+Writes synthetic trip CSVs in every layout Blue Bikes has published, for benchmarking without network access.
+
+    v0    up to 202004, with birth year and gender
+    v1    202005 to 202303, with postal code
+    v2    from 202304, alphanumeric station ids and no tripduration
+    v2ms  v2 with fractional seconds, as published from 2024
+
+Usage: python benchmarks/synthetic_trips.py output_dir [rows per file]
+"""
+import csv
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+# month of the file name for each layout
+LAYOUT_MONTHS = {
+    'v0': '201907',
+    'v1': '202107',
+    'v2': '202307',
+    'v2ms': '202407',
+}
+
+LAYOUT_HEADERS = {
+    'v0': ["tripduration", "starttime", "stoptime", "start station id", "start station name",
+           "start station latitude", "start station longitude", "end station id", "end station name",
+           "end station latitude", "end station longitude", "bikeid", "usertype", "birth year", "gender"],
+    'v1': ["tripduration", "starttime", "stoptime", "start station id", "start station name",
+           "start station latitude", "start station longitude", "end station id", "end station name",
+           "end station latitude", "end station longitude", "bikeid", "usertype", "postal code"],
+    'v2': ["ride_id", "rideable_type", "started_at", "ended_at", "start_station_name", "start_station_id",
+           "end_station_name", "end_station_id", "start_lat", "start_lng", "end_lat", "end_lng", "member_casual"],
+}
+LAYOUT_HEADERS['v2ms'] = LAYOUT_HEADERS['v2']
+
+STREETS = ["Main St", "Mass Ave", "Broadway", "Beacon St", "Harvard Ave", "Cambridge St", "Boylston St",
+           "Washington St", "Centre St", "Tremont St", "Commonwealth Ave", "Summer St"]
+NUM_STATIONS = 400
+
+
+def generate_stations(rng):
+    stations = []
+    for i in range(NUM_STATIONS):
+        name = "%s at %s" % (rng.choice(STREETS), rng.choice(STREETS))
+        # around Boston, spread like the real network
+        lat = 42.36 + rng.gauss(0, 0.03)
+        lng = -71.08 + rng.gauss(0, 0.04)
+        stations.append((i + 3, "%s%05d" % (rng.choice("ABCDKMV"), 30000 + i), name, lat, lng))
+    return stations
+
+
+def write_trip_csv(path, layout, rows, seed=0):
+    """
+    Writes rows trips of the layout to path, the same seed always gives the same file
+    """
+    rng = random.Random(seed)
+    stations = generate_stations(rng)
+    month_start = datetime.strptime(LAYOUT_MONTHS[layout], "%Y%m")
+    v2 = layout.startswith('v2')
+    with open(path, 'w', newline='') as f:
+        # older files quote every field, newer ones leave the coordinates unquoted
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC if v2 else csv.QUOTE_ALL)
+        writer.writerow(LAYOUT_HEADERS[layout])
+        for _ in range(rows):
+            start_station = rng.choice(stations)
+            end_station = rng.choice(stations)
+            started_at = month_start + timedelta(seconds=rng.randint(0, 30 * 86400))
+            duration = timedelta(seconds=int(rng.lognormvariate(6.5, 0.8)) + 60)
+            if layout == 'v2ms':
+                started_at += timedelta(microseconds=rng.randint(0, 999999))
+                duration += timedelta(microseconds=rng.randint(0, 999999))
+            ended_at = started_at + duration
+            writer.writerow(_row(rng, layout, start_station, end_station, started_at, ended_at, duration))
+
+
+def _row(rng, layout, start_station, end_station, started_at, ended_at, duration):
+    if layout.startswith('v2'):
+        times = [_v2_timestamp(started_at, layout), _v2_timestamp(ended_at, layout)]
+        return (["%016X" % rng.getrandbits(64), rng.choice(["classic_bike", "electric_bike"])] + times +
+                [start_station[2], start_station[1], end_station[2], end_station[1],
+                 start_station[3], start_station[4], end_station[3], end_station[4],
+                 rng.choice(["member", "member", "casual"])])
+
+    # these years were published with four fractional digits
+    row = [str(int(duration.total_seconds())),
+           "%s.%04d" % (started_at.strftime("%Y-%m-%d %H:%M:%S"), rng.randint(0, 9999)),
+           "%s.%04d" % (ended_at.strftime("%Y-%m-%d %H:%M:%S"), rng.randint(0, 9999)),
+           str(start_station[0]), start_station[2], "%.6f" % start_station[3], "%.6f" % start_station[4],
+           str(end_station[0]), end_station[2], "%.6f" % end_station[3], "%.6f" % end_station[4],
+           str(rng.randint(1, 5000)), rng.choice(["Subscriber", "Subscriber", "Customer"])]
+    if layout == 'v0':
+        return row + [str(rng.randint(1940, 2004)), str(rng.choice([0, 1, 2]))]
+    return row + [rng.choice(["02139", "02116", "02215", "02138", "\\N"])]
+
+
+def _v2_timestamp(value, layout):
+    if layout == 'v2ms':
+        # milliseconds
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def write_trip_csvs(output_dir, rows, layouts=tuple(LAYOUT_MONTHS)):
+    """
+    Writes one file per layout named like the published files and returns their paths
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for seed, layout in enumerate(layouts):
+        path = os.path.join(output_dir, "%s-bluebikes-tripdata.csv" % LAYOUT_MONTHS[layout])
+        write_trip_csv(path, layout, rows, seed)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    for path in write_trip_csvs(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 100000):
+        print(path)
@@ -0,0 +1,60 @@
+"""
+Compares per-row datetime.strptime with bluebikes.timestamps.durations for deriving trip durations.
+
+Usage: python benchmarks/timestamps_benchmark.py [rows]
+"""
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bluebikes import insert
+from bluebikes import timestamps
+
+
+def generate_timestamps(rows, with_ms):
+    date_fmt = timestamps.DATE_FORMAT_WITH_MS if with_ms else timestamps.DATE_FORMAT
+    month_start = datetime(2024, 6, 1)
+    started_at = []
+    ended_at = []
+    for _ in range(rows):
+        start = month_start + timedelta(seconds=random.randint(0, 30 * 86400), microseconds=random.randint(0, 999999))
+        end = start + timedelta(seconds=random.randint(60, 5000))
+        started_at.append(start.strftime(date_fmt))
+        ended_at.append(end.strftime(date_fmt))
+    return started_at, ended_at
+
+
+def strptime_durations(started_at, ended_at, date_fmt):
+    return [(datetime.strptime(end, date_fmt) - datetime.strptime(start, date_fmt)).total_seconds()
+            for start, end in zip(started_at, ended_at)]
+
+
+def batched_durations(started_at, ended_at):
+    result = []
+    for i in range(0, len(started_at), insert.BULK_INSERT_SIZE):
+        batch = slice(i, i + insert.BULK_INSERT_SIZE)
+        result.extend(timestamps.durations(started_at[batch], ended_at[batch]))
+    return result
+
+
+def main(rows):
+    for with_ms in [False, True]:
+        date_fmt = timestamps.DATE_FORMAT_WITH_MS if with_ms else timestamps.DATE_FORMAT
+        started_at, ended_at = generate_timestamps(rows, with_ms)
+
+        start = time.perf_counter()
+        expected = strptime_durations(started_at, ended_at, date_fmt)
+        strptime_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = batched_durations(started_at, ended_at)
+        batched_seconds = time.perf_counter() - start
+
+        assert actual == expected
+        print("%-22s strptime: %10.0f rows/s   batched: %10.0f rows/s   speedup: %.1fx" % (
+            date_fmt, rows / strptime_seconds, rows / batched_seconds, strptime_seconds / batched_seconds))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,81 @@
+import numpy as np
+
+# mean earth radius, the same one the haversine package uses
+EARTH_RADIUS_METERS = 6371.0088 * 1000
+
+
+def haversine_meters(lat1, lng1, lat2, lng2):
+    """
+    Returns the great circle distance in meters between points given in degrees. The arguments are scalars
+    or arrays that numpy broadcasts against each other, e.g. one point and arrays of many points for the
+    distances from one to many. NaN coordinates give a NaN distance.
+    """
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lng1, lat2, lng2))
+    # the same formula as the haversine package, the results only differ in the last bit of rounding
+    d = np.sin((lat2 - lat1) * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) * 0.5) ** 2
+    return 2 * np.arcsin(np.sqrt(d)) * EARTH_RADIUS_METERS
+
+
+def distance_matrix(lats1, lngs1, lats2, lngs2):
+    """
+    Returns the len(lats1) x len(lats2) array of distances in meters between every pair of points
+    """
+    return haversine_meters(np.asarray(lats1, dtype=np.float64)[:, np.newaxis],
+                            np.asarray(lngs1, dtype=np.float64)[:, np.newaxis], lats2, lngs2)
+
+
+def nearest_within(lat, lng, lats, lngs, max_distance, k=1):
+    """
+    Returns (indexes, meters) arrays of the up to k points of lats/lngs closest to the point that are within
+    max_distance meters of it, closest first and in the order of lats/lngs on ties
+    """
+    distances = haversine_meters(lat, lng, lats, lngs)
+    # NaN is never within
+    within = np.flatnonzero(distances <= max_distance)
+    indexes = within[np.argsort(distances[within], kind='stable')[:k]]
+    return indexes, distances[indexes]
+
+
+def to_float64(values):
+    """
+    Converts a list of numbers or numeric strings to a float64 array, with NaN for values that aren't numbers
+    like empty strings or \\N
+    """
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([_parse_single(v) for v in values], dtype=np.float64)
+
+
+def _parse_single(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def valid_coordinates(lats, lngs):
+    """
+    Returns a boolean array that is False where a coordinate is missing, out of range or the 0,0 placeholder
+    """
+    with np.errstate(invalid='ignore'):
+        in_range = (np.abs(lats) <= 90) & (np.abs(lngs) <= 180)
+    return in_range & ~((lats == 0) & (lngs == 0))
+
+
+def trip_metrics(start_lats, start_lngs, end_lats, end_lngs, durations):
+    """
+    Returns (meters, km_per_hour, bad_coordinates) lists for a batch of trips, given lists of coordinates in
+    degrees and durations in seconds as numbers or strings. The distance is None for trips with bad
+    coordinates, the speed also for durations that aren't positive.
+    """
+    start_lats, start_lngs, end_lats, end_lngs = map(to_float64, (start_lats, start_lngs, end_lats, end_lngs))
+    valid = valid_coordinates(start_lats, start_lngs) & valid_coordinates(end_lats, end_lngs)
+    seconds = to_float64(durations)
+    # the values of bad coordinates and durations are computed as well and replaced by nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        meters = np.where(valid, haversine_meters(start_lats, start_lngs, end_lats, end_lngs), np.nan)
+        km_per_hour = np.where(seconds > 0, meters / seconds * 3.6, np.nan)
+    # nan is the only value not equal to itself
+    return ([None if m != m else m for m in meters.tolist()], [None if s != s else s for s in km_per_hour.tolist()],
+            (~valid).astype(np.int64).tolist())
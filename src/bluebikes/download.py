@@ -1,60 +1,219 @@
-import glob
-import os
-import shutil
-import zipfile
-
-import boto3
-from botocore import client, UNSIGNED
-from tqdm.contrib.concurrent import process_map
-
-BUCKET_NAME = 'hubway-data'
-
-boto_config = client.Config(
-    region_name='us-east-2',
-    signature_version=UNSIGNED,  # anonymous public access credentials
-    retries={
-        'max_attempts': 3,
-        'mode': 'standard'
-    }
-)
-s3 = boto3.client('s3', config=boto_config)
-
-
-def download_and_extract(workers, data_dir):
-    s3_files = _get_files_to_download(BUCKET_NAME)
-    print("==== Downloading files from S3 ====")
-    target_dirs = [data_dir] * len(s3_files)
-    process_map(_download_file, s3_files, target_dirs, max_workers=workers)
-    zip_files = _get_files_to_unzip(data_dir)
-    print("==== Unzipping files ====")
-    process_map(_extract_zip, zip_files, target_dirs, max_workers=workers)
-
-    # some of the BB files were zipped with hidden __MACOSX directories
-    mac_artifact = os.path.join(data_dir, '__MACOSX')
-    shutil.rmtree(mac_artifact)
-
-
-def _download_file(object_to_download, data_dir):
-    object_name, size = object_to_download
-    file_name = object_name.split('/')[-1]
-    file_path = os.path.join(data_dir, file_name)
-    if os.path.isfile(file_path) and os.stat(file_path).st_size == size:
-        return
-    else:
-        s3.download_file(BUCKET_NAME, object_name, file_path)
-
-
-def _get_files_to_download(bucket):
-    response = s3.list_objects_v2(Bucket=bucket)
-    files_in_bucket = [(item['Key'], item['Size']) for item in response['Contents']]
-    return files_in_bucket
-
-
-def _get_files_to_unzip(data_dir):
-    pattern = os.path.join(data_dir, '*.zip')
-    return glob.glob(pattern)
-
-
-def _extract_zip(zip_file, data_dir):
-    with zipfile.ZipFile(zip_file, "r") as zip_ref:
-        zip_ref.extractall(data_dir)
+import glob
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from botocore import client, UNSIGNED
+from tqdm import tqdm
+
+import bluebikes.sources
+
+BUCKET_NAME = 'hubway-data'
+
+# records which trip CSVs are in which S3 object so the insert step can fill in the manifest
+LISTING_FILE = 'listing.json'
+
+# records the etag of every completely downloaded object, so cached files are only reused while unchanged
+DOWNLOAD_CACHE_FILE = 'downloads.json'
+
+# downloads are network bound, so they run on threads sharing one pool of connections
+DOWNLOAD_THREADS = 16
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+boto_config = client.Config(
+    region_name='us-east-2',
+    signature_version=UNSIGNED,  # anonymous public access credentials
+    max_pool_connections=DOWNLOAD_THREADS,
+    retries={
+        'max_attempts': 3,
+        'mode': 'standard'
+    }
+)
+s3 = boto3.client('s3', config=boto_config)
+
+_download_cache_lock = threading.Lock()
+
+
+class S3Bucket:
+    """
+    Reads objects of an S3 bucket, by default the public Blue Bikes bucket
+    """
+
+    def __init__(self, name=BUCKET_NAME, s3_client=s3):
+        self.name = name
+        self._client = s3_client
+
+    def list_objects(self):
+        # a single list_objects_v2 call stops at 1000 keys
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.name):
+            for item in page.get('Contents', []):
+                yield item['Key'], item['Size'], item['ETag'].strip('"')
+
+    def read(self, key, etag, start=0):
+        """
+        Yields the bytes of the object from the start offset on. Fails when the object no longer has the etag.
+        """
+        kwargs = {'Bucket': self.name, 'Key': key, 'IfMatch': '"%s"' % etag}
+        if start:
+            kwargs['Range'] = 'bytes=%s-' % start
+        body = self._client.get_object(**kwargs)['Body']
+        try:
+            yield from body.iter_chunks(DOWNLOAD_CHUNK_SIZE)
+        finally:
+            body.close()
+
+
+class LocalBucket:
+    """
+    Serves the files below a local directory like a bucket, e.g. a mirror of the S3 bucket or a test fixture.
+    Keys are paths relative to the directory and etags are MD5 digests, like those of single part S3 uploads.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_objects(self):
+        for path in sorted(glob.glob(os.path.join(self.root, '**', '*'), recursive=True)):
+            if os.path.isfile(path):
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                yield key, os.path.getsize(path), _md5(path)
+
+    def read(self, key, etag, start=0):
+        path = os.path.join(self.root, *key.split('/'))
+        if _md5(path) != etag:
+            raise ValueError("%s changed while it was being downloaded" % key)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            yield from iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b'')
+
+
+def download_files(data_dir, s3_files=None, bucket=None, threads=DOWNLOAD_THREADS):
+    """
+    Download objects from the bucket. By default every object is fetched, pass a subset from list_bucket()
+    to only download those. Files downloaded by a previous run are kept while their etag is unchanged and
+    interrupted downloads are resumed. The zip archives are not extracted, the insert step reads the CSVs
+    out of them. Returns the number of bytes that were transferred.
+    """
+    return sum(downloaded for _, _, downloaded in iter_downloads(data_dir, s3_files, bucket, threads))
+
+
+def iter_downloads(data_dir, s3_files=None, bucket=None, threads=DOWNLOAD_THREADS):
+    """
+    Like download_files(), but yields ((key, size, etag), trip_sources, bytes_downloaded) for every object
+    as soon as its download has finished, with the TripSources of the trip CSVs it contains. The listing
+    is updated before each object is yielded.
+    """
+    bucket = bucket or S3Bucket()
+    if s3_files is None:
+        s3_files = list_bucket(bucket)
+    print("==== Downloading files from S3 ====")
+    cached_etags = _cached_etags(data_dir)
+    progress = tqdm(total=len(s3_files), desc="Downloading")
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(_download_file, s3_object, data_dir, bucket, cached_etags): s3_object
+                   for s3_object in s3_files}
+        for future in as_completed(futures):
+            downloaded = future.result()
+            progress.update()
+            s3_object = futures[future]
+            trip_sources = []
+            if s3_object[0].endswith('.zip'):
+                trip_sources = bluebikes.sources.archive_sources(_local_path(s3_object[0], data_dir), data_dir)
+                _write_listing(data_dir, [s3_object], [[source.src_file for source in trip_sources]])
+            yield s3_object, trip_sources, downloaded
+    progress.close()
+
+
+def list_bucket(bucket=None):
+    """
+    Returns a list of (key, size, etag) tuples for every object in the bucket
+    """
+    return list((bucket or S3Bucket()).list_objects())
+
+
+def read_listing(data_dir):
+    """
+    Returns the S3 metadata of previously downloaded archives keyed by object name.
+    Each value is a dict with the size, etag and the src_file of every trip CSV in the archive.
+    """
+    return _read_json(os.path.join(data_dir, LISTING_FILE))
+
+
+def _read_json(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_listing(data_dir, zip_objects, members):
+    # merge with any previous listing so partial (incremental) downloads don't forget older archives
+    listing = read_listing(data_dir)
+    for (object_name, size, etag), csv_files in zip(zip_objects, members):
+        listing[object_name] = {'size': size, 'etag': etag, 'members': csv_files}
+    with open(os.path.join(data_dir, LISTING_FILE), 'w') as f:
+        json.dump(listing, f, indent=2)
+
+
+def _cached_etags(data_dir):
+    # archives in the listing were complete when it was written
+    etags = {object_name: info['etag'] for object_name, info in read_listing(data_dir).items()}
+    etags.update(_read_json(os.path.join(data_dir, DOWNLOAD_CACHE_FILE)))
+    return etags
+
+
+def _record_download(data_dir, object_name, etag):
+    with _download_cache_lock:
+        cache_file = os.path.join(data_dir, DOWNLOAD_CACHE_FILE)
+        cache = _read_json(cache_file)
+        cache[object_name] = etag
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f, indent=2)
+
+
+def _local_path(object_name, data_dir):
+    file_name = object_name.split('/')[-1]
+    return os.path.join(data_dir, file_name)
+
+
+def _partial_path(file_path, etag):
+    # the etag is part of the name so a partial download is only resumed for the same version of the object
+    return '%s.%s.part' % (file_path, etag)
+
+
+def _download_file(object_to_download, data_dir, bucket, cached_etags):
+    object_name, size, etag = object_to_download
+    file_path = _local_path(object_name, data_dir)
+    if cached_etags.get(object_name) == etag and os.path.isfile(file_path) and os.stat(file_path).st_size == size:
+        return 0
+
+    partial_path = _partial_path(file_path, etag)
+    for stale in glob.glob(glob.escape(file_path) + '.*.part'):
+        if stale != partial_path:
+            os.remove(stale)
+
+    offset = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+    if offset > size:
+        os.remove(partial_path)
+        offset = 0
+    if offset < size:
+        with open(partial_path, 'ab') as f:
+            for chunk in bucket.read(object_name, etag, offset):
+                f.write(chunk)
+    else:
+        open(partial_path, 'ab').close()
+    os.replace(partial_path, file_path)
+    _record_download(data_dir, object_name, etag)
+    return size - offset
+
+
+def _md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
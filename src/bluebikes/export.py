@@ -0,0 +1,144 @@
+import os
+import re
+
+from tqdm.contrib.concurrent import process_map
+
+import bluebikes.insert
+import bluebikes.sources
+import bluebikes.timestamps
+
+# extracts YYYYMM from file names
+MONTH_YEAR_RE = r'(20[0-4]\d)(0[1-9]|1[0-2])'
+
+# rows are buffered until a row group of this size can be written
+PARQUET_ROW_GROUP_SIZE = 250000
+
+# every column of the bluebikes table except the id, with the name of its arrow type
+PARQUET_COLUMNS = [
+    ('src_file', 'string'),
+    ('tripduration', 'float64'),
+    ('started_at', 'timestamp'),
+    ('ended_at', 'timestamp'),
+    ('start_id', 'string'),
+    ('start_station_name', 'string'),
+    ('start_lat', 'float64'),
+    ('start_lng', 'float64'),
+    ('end_id', 'string'),
+    ('end_station_name', 'string'),
+    ('end_lat', 'float64'),
+    ('end_lng', 'float64'),
+    ('ride_id', 'string'),
+    ('usertype', 'string'),
+    ('birth_year', 'int32'),
+    ('gender', 'string'),
+    ('rideable_type', 'string'),
+    ('postal_code', 'string'),
+    ('distance_meters', 'float64'),
+    ('speed_kmh', 'float64'),
+    ('bad_coordinates', 'int32'),
+]
+
+
+def export_parquet(files, output_dir, num_workers=os.cpu_count()):
+    """
+    Writes each trip CSV (a TripSource or path) to output_dir/year=YYYY/month=MM/<name>.parquet with typed
+    columns, parsed by the same pipeline as the SQLite import. Requires the optional pyarrow package.
+    """
+    _import_pyarrow()
+    process_map(_export_csv_to_parquet, files, [output_dir] * len(files), max_workers=num_workers)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Exporting to parquet requires pyarrow, install it with `pip install pyarrow`")
+    return pyarrow, pyarrow.parquet
+
+
+def _partition_path(file, output_dir):
+    file_name = os.path.basename(file)
+    match = re.search(MONTH_YEAR_RE, file_name)
+    if match is None:
+        raise ValueError("Can't find the YYYYMM month of %s in its name" % file)
+    year, month = match.groups()
+    parquet_name = os.path.splitext(file_name)[0] + '.parquet'
+    return os.path.join(output_dir, 'year=%s' % year, 'month=%s' % month, parquet_name)
+
+
+def _export_csv_to_parquet(file, output_dir):
+    source = bluebikes.sources.as_source(file)
+    try:
+        _write_parquet(source, _partition_path(source.src_file, output_dir))
+    except ValueError as e:
+        print("Skipping %s: %s" % (source.src_file, e))
+
+
+def _write_parquet(source, path):
+    pa, pq = _import_pyarrow()
+    arrow_schema = _arrow_schema(pa)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with pq.ParquetWriter(path, arrow_schema) as writer:
+        buffered_columns = None
+        buffered_rows = []
+        for columns, rows in bluebikes.insert.read_batches(source):
+            if columns != buffered_columns and buffered_rows:
+                writer.write_table(_to_table(pa, arrow_schema, buffered_columns, buffered_rows))
+                buffered_rows = []
+            buffered_columns = columns
+            buffered_rows.extend(rows)
+            if len(buffered_rows) >= PARQUET_ROW_GROUP_SIZE:
+                writer.write_table(_to_table(pa, arrow_schema, buffered_columns, buffered_rows))
+                buffered_rows = []
+        if buffered_rows:
+            writer.write_table(_to_table(pa, arrow_schema, buffered_columns, buffered_rows))
+
+
+def _arrow_schema(pa):
+    arrow_types = {
+        'string': pa.string(),
+        'float64': pa.float64(),
+        'int32': pa.int32(),
+        'timestamp': pa.timestamp('us'),
+    }
+    return pa.schema([(name, arrow_types[type_name]) for name, type_name in PARQUET_COLUMNS])
+
+
+def _to_table(pa, arrow_schema, columns, rows):
+    values_by_column = dict(zip(columns, zip(*rows)))
+    arrays = []
+    for field in arrow_schema:
+        values = values_by_column.get(field.name)
+        if values is None:
+            arrays.append(pa.nulls(len(rows), field.type))
+        else:
+            arrays.append(_to_array(pa, list(values), field.type))
+    return pa.Table.from_arrays(arrays, schema=arrow_schema)
+
+
+def _to_array(pa, values, arrow_type):
+    if pa.types.is_timestamp(arrow_type):
+        return pa.array(bluebikes.timestamps.to_datetime64(values))
+    if pa.types.is_string(arrow_type):
+        return pa.array(values, arrow_type)
+    if values and not isinstance(values[0], str):
+        # durations derived from the timestamps are already numbers
+        return pa.array(values, arrow_type)
+    try:
+        # clean numeric strings are converted in bulk
+        return pa.array(values, pa.string()).cast(arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([_to_number(v, arrow_type, pa) for v in values], arrow_type)
+
+
+def _to_number(value, arrow_type, pa):
+    # empty strings and placeholders like \N become nulls
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if number != number:
+        return None
+    return int(number) if pa.types.is_integer(arrow_type) else number
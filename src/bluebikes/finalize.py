@@ -0,0 +1,26 @@
+import sqlite3
+import time
+
+import bluebikes.sql
+
+DEFAULT_INDEXES = list(bluebikes.sql.indexes)
+
+
+def finalize(database, index_names=DEFAULT_INDEXES, layout='wide'):
+    """
+    Builds the requested indexes and refreshes the query planner statistics. This runs once after all rows
+    are inserted, since maintaining the indexes during the bulk load would slow down every insert.
+    """
+    index_statements = bluebikes.sql.normalized_indexes if layout == 'normalized' else bluebikes.sql.indexes
+    conn = sqlite3.connect(database, isolation_level=None)
+
+    for name in index_names:
+        start = time.perf_counter()
+        conn.execute(index_statements[name])
+        print("Built index %s in %.1fs" % (name, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    print("Analyzed database in %.1fs" % (time.perf_counter() - start))
+    conn.close()
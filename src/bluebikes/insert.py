@@ -1,153 +1,830 @@
-import csv
-import glob
-import os
-import re
-import sqlite3
-from datetime import datetime
-
-import bluebikes.sql
-
-# extracts YYYYMM from file names
-MONTH_YEAR_RE = r'(20[0-4]\d)(0[1-9]|1[0-2])'
-DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
-# bluebikes started including fractional time in 2024
-DATE_FORMAT_WITH_MS = "%Y-%m-%d %H:%M:%S.%f"
-
-DATABASE = 'bluebike.sqlite'
-BULK_INSERT_SIZE = 1000
-DATABASE_LOCK_TIMEOUT = 900  # 15 minutes
-
-
-def evenly_distribute_csv_files_for_insert_by_total_size(num_workers, data_dir):
-    # find all CSV files and their sizes
-    pattern = os.path.join(data_dir, '*tripdata.csv')
-    files = [(file, os.path.getsize(file)) for file in glob.glob(pattern)]
-
-    # sort files by size in descending order (optional but helps in distribution)
-    files.sort(key=lambda x: x[1], reverse=True)
-
-    # initialize distribution dictionary
-    distribution = {i: [] for i in range(num_workers)}  # Each worker has an empty list of files
-    workers = [{'id': i, 'total_size': 0} for i in range(num_workers)]
-
-    # distribute files uniformly across workers
-    for file, size in files:
-        # Find the worker with the minimum total size
-        min_worker = min(workers, key=lambda x: x['total_size'])
-        distribution[min_worker['id']].append(file)  # Add only file path, not size
-        min_worker['total_size'] += size
-
-    return distribution
-
-
-def insert_rows_from_list_of_csvs(worker_assignments, database=DATABASE):
-    worker_number, files = worker_assignments
-    memory_conn, cursor = _initialize_in_memory_database(worker_number)
-
-    for f in files:
-        _insert_rows_from_single_csv(f, cursor)
-
-    _dump_memory_db_to_file(memory_conn, database)
-    memory_conn.close()
-
-
-def print_csv_header(file):
-    """
-    Helper function to print the first line of a CSV file. Useful for schema debugging
-    """
-    with open(file, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',', quotechar='|')
-        for row in reader:
-            print((file, row))
-            return
-
-
-def _insert_rows_from_single_csv(file, cursor):
-    year, month = re.findall(MONTH_YEAR_RE, file)[0]
-    month_year = int('%s%s' % (year, month))
-
-    with open(file, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        insert_count = 0
-        passed_header_row = False
-        data_to_insert = []
-        for row in reader:
-            if not passed_header_row:
-                passed_header_row = True
-                # ensure we skip the header row
-                continue
-
-            row.insert(0, file)
-            data_to_insert.append(row)
-            insert_count += 1
-
-            # newer records drop duration
-            if 202304 <= month_year:
-                date_fmt = DATE_FORMAT_WITH_MS if (202406 <= month_year) else DATE_FORMAT
-                end_date = datetime.strptime(row[4], date_fmt)
-                start_date = datetime.strptime(row[3], date_fmt)
-                time_delta = end_date - start_date
-                row.insert(3, time_delta.total_seconds())
-
-            if insert_count == BULK_INSERT_SIZE:
-                _bulk_insert_by_schema(data_to_insert, month_year, cursor)
-                insert_count = 0
-                data_to_insert = []
-
-    # insert any outstanding records from the last batch
-    _bulk_insert_by_schema(data_to_insert, month_year, cursor)
-
-
-def _bulk_insert_by_schema(data_to_insert, month_year, cursor):
-    if month_year <= 202004:
-        insert_stmt = bluebikes.sql.insert_stmt_v0
-    elif 202005 <= month_year <= 202303:
-        insert_stmt = bluebikes.sql.insert_stmt_v1
-    elif 202304 <= month_year:
-        insert_stmt = bluebikes.sql.insert_stmt_v2
-    else:
-        return
-    try:
-        cursor.executemany(insert_stmt, data_to_insert)
-    except Exception as e:
-        print(e)
-        # print(data_to_insert)
-
-
-def _initialize_in_memory_database(worker_number):
-    memory_conn = sqlite3.connect(':memory:', timeout=DATABASE_LOCK_TIMEOUT, isolation_level=None)
-    _configure_sqlite_pragma(memory_conn, "memory")
-    cursor = memory_conn.cursor()
-    cursor.execute(bluebikes.sql.table_create)
-    _seed_auto_increment(cursor, worker_number)
-
-    return memory_conn, cursor
-
-
-def _configure_sqlite_pragma(connection, journal_mode="WAL"):
-    connection.execute("PRAGMA synchronous = OFF")
-    connection.execute("PRAGMA journal_mode = %s" % journal_mode)
-    connection.execute('PRAGMA busy_timeout = %s' % (DATABASE_LOCK_TIMEOUT * 1000))
-
-
-def _seed_auto_increment(cursor, worker_number):
-    """
-    This insert will seed the auto-increment primary key at a value related to the worker number.
-    This is required to avoid ID collisions when dumping the in-memory database into the file.
-    It will be deleted immediately.
-    """
-    auto_increment_start_id = worker_number * 100000000
-    cursor.execute(bluebikes.sql.id_insert, [auto_increment_start_id])
-    cursor.execute("delete from bluebikes where rowid=?", [auto_increment_start_id])
-
-
-def _dump_memory_db_to_file(memory_conn, database=DATABASE):
-    """
-    Insert data from the in-memory table to the file-based table
-    """
-    file_conn = sqlite3.connect(database, timeout=DATABASE_LOCK_TIMEOUT, isolation_level=None)
-    _configure_sqlite_pragma(file_conn)
-    memory_conn.execute('ATTACH DATABASE "%s" AS filedb' % database)
-    memory_conn.execute('INSERT INTO filedb.bluebikes SELECT * FROM bluebikes')
-    memory_conn.execute('DETACH DATABASE filedb')
-    file_conn.close()
+import csv
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from functools import partial
+from itertools import islice
+
+from tqdm import tqdm
+
+import bluebikes.metrics
+import bluebikes.normalized
+import bluebikes.rollups
+import bluebikes.scheduler
+import bluebikes.schema
+import bluebikes.sources
+import bluebikes.sql
+
+DATABASE = 'bluebike.sqlite'
+BULK_INSERT_SIZE = 1000
+DATABASE_LOCK_TIMEOUT = 900  # 15 minutes
+
+# 'memory' builds an in-memory database per worker, 'stream' sends batches from parser processes to one writer,
+# 'shards' has every worker write its own shard database and merges them into the file database at the end
+INSERT_STRATEGIES = ['memory', 'stream', 'shards']
+# 'wide' stores every column on each row, 'normalized' moves repeated strings into dimension tables (stream only)
+LAYOUTS = ['wide', 'normalized']
+# peak memory of the stream strategy is bounded by BULK_INSERT_SIZE * STREAM_QUEUE_DEPTH rows
+STREAM_QUEUE_DEPTH = 64
+# the stream writer commits after this many batches, unless it is in the middle of replacing a file
+STREAM_COMMIT_INTERVAL = 500
+# CSVs larger than this are split into newline aligned chunks parsed by different stream parsers
+STREAM_CHUNK_SIZE = 64 * 1024 * 1024
+# 'csv' parses rows with the csv module, 'arrow' parses blocks of rows with pyarrow (optional dependency)
+CSV_PARSERS = ['csv', 'arrow']
+# bytes of CSV the arrow parser converts at once
+ARROW_BLOCK_SIZE = 1024 * 1024
+# memory workers copy their rows into the file database whenever they loaded this many bytes of CSV since the
+# last copy, which bounds the work an interrupted import loses, see delete_partial_files()
+CHECKPOINT_SIZE = 512 * 1024 * 1024
+# estimated resident memory of a worker process apart from its database, see the peak_rss_mb of --report
+WORKER_MEMORY_MB = 64
+# estimated memory of one batch of BULK_INSERT_SIZE rows on the stream queue
+BATCH_MEMORY_MB = 1
+# another memory worker is only started when its database can keep at least this much in memory
+MIN_DATABASE_MEMORY_MB = 64
+# SQLite's default limit on attached databases, more shards are folded into the first ones before the merge
+MAX_ATTACHED_SHARDS = 10
+
+
+def evenly_distribute_csv_files_for_insert_by_total_size(num_workers, data_dir, csv_files=None):
+    # find all CSV files and their (uncompressed) sizes
+    if csv_files is None:
+        csv_files = bluebikes.sources.find_sources(data_dir)
+    files = [(source, source.size) for source in map(bluebikes.sources.as_source, csv_files)]
+
+    # sort files by size in descending order (optional but helps in distribution)
+    files.sort(key=lambda x: x[1], reverse=True)
+
+    # initialize distribution dictionary
+    distribution = {i: [] for i in range(num_workers)}  # Each worker has an empty list of files
+    workers = [{'id': i, 'total_size': 0} for i in range(num_workers)]
+
+    # distribute files uniformly across workers
+    for file, size in files:
+        # Find the worker with the minimum total size
+        min_worker = min(workers, key=lambda x: x['total_size'])
+        distribution[min_worker['id']].append(file)  # Add only file path, not size
+        min_worker['total_size'] += size
+
+    return distribution
+
+
+def insert_rows_from_list_of_csvs(worker_assignments, database=DATABASE, file_metadata=None, id_offset=0):
+    """
+    Load the assigned files into an in-memory database, then replace their rows in the file database.
+    Files are TripSources or CSV paths. file_metadata optionally maps each src_file to the
+    (s3_key, s3_size, s3_etag) of its archive.
+    id_offset must be at least the largest id already in the file database, see max_id()
+    """
+    worker_number, files = worker_assignments
+    memory_conn, cursor = _initialize_in_memory_database(worker_number, id_offset)
+
+    loaded_files = [source.src_file for source in map(bluebikes.sources.as_source, files)
+                    if _insert_rows_from_single_csv(source, cursor) is not None]
+
+    _dump_memory_db_to_file(memory_conn, loaded_files, database, file_metadata)
+    memory_conn.close()
+
+
+def memory_worker_budget(max_memory_mb, num_workers=os.cpu_count()):
+    """
+    Splits a memory budget in MB between memory workers. Returns how many workers to run, at most num_workers,
+    and how many bytes of its database each of them may keep in memory before spilling it to disk.
+    """
+    workers = max(1, min(num_workers, max_memory_mb // (WORKER_MEMORY_MB + MIN_DATABASE_MEMORY_MB)))
+    database_mb = max(1, max_memory_mb // workers - WORKER_MEMORY_MB)
+    return workers, database_mb * 1024 * 1024
+
+
+def stream_worker_budget(max_memory_mb, num_workers=os.cpu_count(), queue_depth=STREAM_QUEUE_DEPTH):
+    """
+    Splits a memory budget in MB between the stream writer, the batches on its queue and the parsers.
+    Returns how many parsers to run, at most num_workers, and the queue depth, which is reduced when a full
+    queue would take more than half of the budget.
+    """
+    queue_depth = max(1, min(queue_depth, max_memory_mb // 2 // BATCH_MEMORY_MB))
+    parsers = (max_memory_mb - WORKER_MEMORY_MB - queue_depth * BATCH_MEMORY_MB) // WORKER_MEMORY_MB
+    return max(1, min(num_workers, parsers)), queue_depth
+
+
+def memory_insert_csvs(files, database=DATABASE, num_workers=os.cpu_count(), file_metadata=None, id_offset=0,
+                       profile_dir=None, max_database_bytes=None, shard_pattern=None, csv_parser='csv'):
+    """
+    Like insert_rows_from_list_of_csvs(), but instead of a fixed assignment every worker pulls the next file
+    from a shared queue ordered by estimated cost, so a slow file can't leave one worker as the tail of the
+    import. The time each file takes is recorded in bluebikes_load_stats to order the next run.
+    Returns the WorkerStats of every worker as dicts. With a profile_dir each worker writes its cProfile stats.
+    With max_database_bytes the workers' databases spill to temporary files once they grow past that size,
+    see memory_worker_budget(). With a shard_pattern, each worker writes its rows to the database
+    shard_pattern % worker_number instead of the file database, see shard_insert_csvs(). csv_parser is one
+    of CSV_PARSERS.
+    """
+    sources = [bluebikes.sources.as_source(f) for f in files]
+    file_queue = multiprocessing.Queue()
+    for source in bluebikes.scheduler.order_by_cost(sources, bluebikes.scheduler.read_load_stats(database)):
+        file_queue.put(source)
+    progress_queue = multiprocessing.Queue()
+
+    workers = []
+    for worker_number in range(num_workers):
+        file_queue.put(None)
+        worker = multiprocessing.Process(target=_insert_rows_from_file_queue, args=(
+            worker_number, file_queue, progress_queue, database, file_metadata, id_offset, profile_dir,
+            max_database_bytes, shard_pattern, csv_parser))
+        worker.start()
+        workers.append(worker)
+
+    worker_stats = []
+    with tqdm(total=len(sources), desc="Inserting files") as progress:
+        while len(worker_stats) < num_workers:
+            message = progress_queue.get()
+            if isinstance(message, dict):
+                worker_stats.append(message)
+            else:
+                progress.update()
+    for worker in workers:
+        worker.join()
+    return worker_stats
+
+
+def _insert_rows_from_file_queue(worker_number, file_queue, progress_queue, database, file_metadata, id_offset,
+                                 profile_dir=None, max_database_bytes=None, shard_pattern=None, csv_parser='csv'):
+    """
+    Worker process: loads files from the queue into its in-memory database until it gets None, then copies
+    them into the file database or its shard. Without a shard the rows are also copied every CHECKPOINT_SIZE
+    bytes of CSV. Puts each src_file on the progress queue, and its WorkerStats dict once done.
+    """
+    role = 'memory' if shard_pattern is None else 'shard'
+    stats = bluebikes.metrics.WorkerStats(role, worker_number)
+    with bluebikes.metrics.profiled(profile_dir, '%s-%s' % (role, worker_number)):
+        memory_conn, cursor = _initialize_in_memory_database(worker_number, id_offset, max_database_bytes)
+        loaded_files = []
+        load_stats = []
+        rejected_rows = []
+        for source in iter(file_queue.get, None):
+            start = time.perf_counter()
+            file_rejects = []
+            row_count = _insert_rows_from_single_csv(source, cursor, stats, file_rejects, csv_parser)
+            if row_count is not None:
+                seconds = time.perf_counter() - start
+                loaded_files.append(source.src_file)
+                load_stats.append((source.src_file, source.size, row_count, seconds))
+                rejected_rows += file_rejects
+                stats.add_file(source.src_file, row_count, source.size, seconds, len(file_rejects))
+                _print_rejects(source.src_file, len(file_rejects))
+            progress_queue.put(source.src_file)
+            if shard_pattern is None and sum(size for _, size, _, _ in load_stats) >= CHECKPOINT_SIZE:
+                _dump_memory_db_to_file(memory_conn, loaded_files, database, file_metadata, load_stats, stats,
+                                        rejected_rows)
+                # the autoincrement sequence is kept, so the next rows continue after the copied ones
+                cursor.execute('DELETE FROM bluebikes')
+                loaded_files = []
+                load_stats = []
+                rejected_rows = []
+
+        if shard_pattern is None:
+            _dump_memory_db_to_file(memory_conn, loaded_files, database, file_metadata, load_stats, stats,
+                                    rejected_rows)
+        else:
+            _write_shard(memory_conn, shard_pattern % worker_number, load_stats, rejected_rows)
+        memory_conn.close()
+    progress_queue.put(stats.as_dict())
+
+
+def shard_insert_csvs(files, database=DATABASE, num_workers=os.cpu_count(), file_metadata=None, profile_dir=None,
+                      max_database_bytes=None, csv_parser='csv'):
+    """
+    Like memory_insert_csvs(), but every worker writes its own shard database next to the file database, so
+    the workers never wait on each other for the write lock. The shards are then merged by merge_shards()
+    and removed. Returns the WorkerStats of the workers and the merge as dicts.
+    """
+    shard_pattern = str(database) + '.shard-%s'
+    shards = [shard_pattern % worker_number for worker_number in range(num_workers)]
+    stats = bluebikes.metrics.WorkerStats('merge')
+    try:
+        worker_stats = memory_insert_csvs(files, database, num_workers, file_metadata, 0, profile_dir,
+                                          max_database_bytes, shard_pattern, csv_parser)
+        print("==== Merging %s shards ====" % len(shards))
+        with bluebikes.metrics.profiled(profile_dir, 'merge'):
+            merge_shards(shards, database, file_metadata, stats)
+    finally:
+        for shard in shards:
+            if os.path.exists(shard):
+                os.remove(shard)
+    return worker_stats + [stats.as_dict()]
+
+
+def merge_shards(shards, database=DATABASE, file_metadata=None, stats=None):
+    """
+    Copies the rows of the shard databases into the file database in a single transaction. Files are copied
+    in the order of their first trip and the rows of each file by start time, so the table is clustered by
+    time and its ids increase with it. Rows from a previous load of the same files are replaced and the
+    manifest and load stats are updated, like _dump_memory_db_to_file() does.
+    """
+    file_metadata = file_metadata or {}
+    stats = stats or bluebikes.metrics.WorkerStats('merge')
+    shards = _fold_shards(shards)
+    conn = sqlite3.connect(database, timeout=DATABASE_LOCK_TIMEOUT, isolation_level=None)
+    _configure_sqlite_pragma(conn)
+    create_tables(conn)
+    # the ids of the shards are dropped, the file database numbers the rows in merge order
+    columns = _columns_without_id(conn)
+
+    load_stats = []
+    first_trips = {}
+    for shard_number, shard in enumerate(shards):
+        conn.execute('ATTACH DATABASE ? AS shard%s' % shard_number, [shard])
+        load_stats += conn.execute('SELECT src_file, size, row_count, seconds FROM shard%s.bluebikes_load_stats'
+                                   % shard_number).fetchall()
+        for src_file, first_trip in conn.execute('SELECT src_file, MIN(started_at) FROM shard%s.bluebikes '
+                                                 'GROUP BY src_file' % shard_number):
+            first_trips[src_file] = (first_trip, shard_number)
+    loaded = {src_file for src_file, in conn.execute('SELECT src_file FROM main.bluebikes_manifest')}
+
+    with stats.waiting_for_lock():
+        conn.execute('BEGIN IMMEDIATE')
+    for src_file, size, row_count, seconds in load_stats:
+        if src_file in loaded:
+            conn.execute('DELETE FROM main.bluebikes WHERE src_file = ?', [src_file])
+        conn.execute('DELETE FROM main.bluebikes_rejected_rows WHERE src_file = ?', [src_file])
+        s3_key, s3_size, s3_etag = file_metadata.get(src_file, (None, None, None))
+        conn.execute(bluebikes.sql.manifest_upsert, [src_file, s3_key, s3_size, s3_etag, row_count])
+        conn.execute(bluebikes.sql.load_stats_upsert, [src_file, size, row_count, seconds])
+    for src_file, (_, shard_number) in sorted(first_trips.items(), key=lambda x: x[1][0]):
+        conn.execute('INSERT INTO main.bluebikes (%s) SELECT %s FROM shard%s.bluebikes WHERE src_file = ? '
+                     'ORDER BY started_at' % (columns, columns, shard_number), [src_file])
+    for shard_number in range(len(shards)):
+        conn.execute('INSERT INTO main.bluebikes_rejected_rows SELECT * FROM shard%s.bluebikes_rejected_rows'
+                     % shard_number)
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def _write_shard(memory_conn, shard, load_stats, rejected_rows=()):
+    """
+    Saves the worker's database to the shard file, with its load stats, rejected rows and an index to read
+    the rows of each file in start time order
+    """
+    memory_conn.execute(bluebikes.sql.load_stats_create)
+    memory_conn.executemany(bluebikes.sql.load_stats_upsert, load_stats)
+    memory_conn.execute(bluebikes.sql.rejected_rows_create)
+    memory_conn.executemany(bluebikes.sql.rejected_rows_insert, rejected_rows)
+    memory_conn.execute('CREATE INDEX bluebikes_shard_files ON bluebikes (src_file, started_at)')
+    shard_conn = sqlite3.connect(shard)
+    memory_conn.backup(shard_conn)
+    shard_conn.close()
+
+
+def _fold_shards(shards):
+    """
+    Appends the shards past MAX_ATTACHED_SHARDS to the first ones, so the rest can be attached at once.
+    Returns the remaining shards.
+    """
+    for shard_number, extra in enumerate(shards[MAX_ATTACHED_SHARDS:]):
+        conn = sqlite3.connect(shards[shard_number % MAX_ATTACHED_SHARDS], isolation_level=None)
+        columns = _columns_without_id(conn)
+        conn.execute('ATTACH DATABASE ? AS extra', [extra])
+        conn.execute('BEGIN')
+        conn.execute('INSERT INTO main.bluebikes (%s) SELECT %s FROM extra.bluebikes' % (columns, columns))
+        conn.execute('INSERT INTO main.bluebikes_load_stats SELECT * FROM extra.bluebikes_load_stats')
+        conn.execute('INSERT INTO main.bluebikes_rejected_rows SELECT * FROM extra.bluebikes_rejected_rows')
+        conn.execute('COMMIT')
+        conn.execute('DETACH DATABASE extra')
+        conn.close()
+        os.remove(extra)
+    return shards[:MAX_ATTACHED_SHARDS]
+
+
+def _columns_without_id(conn):
+    return ", ".join(name for _, name, *_ in conn.execute('PRAGMA main.table_info(bluebikes)') if name != 'id')
+
+
+def _stored_columns(conn):
+    # table_info leaves out generated columns
+    return ", ".join(name for _, name, *_ in conn.execute('PRAGMA main.table_info(bluebikes)'))
+
+
+def stream_insert_csvs(files, database=DATABASE, num_workers=os.cpu_count(), file_metadata=None,
+                       queue_depth=STREAM_QUEUE_DEPTH, layout='wide', chunk_size=STREAM_CHUNK_SIZE, profile_dir=None,
+                       csv_parser='csv'):
+    """
+    Parse files in num_workers processes which stream bounded batches over a queue to a single writer
+    running in this process. Only one connection ever writes, so there is no lock contention on the file
+    database and memory use does not grow with the size of the dataset.
+    Files larger than chunk_size are split into chunks, so a single large month is parsed by all workers.
+    With the normalized layout the writer also dictionary encodes the rows.
+    Returns the WorkerStats of the parsers and the writer as dicts.
+    """
+    sources = [bluebikes.sources.as_source(f) for f in files]
+    # the most expensive files go first so the cheapest ones fill in at the end
+    sources = bluebikes.scheduler.order_by_cost(sources, bluebikes.scheduler.read_load_stats(database))
+    return stream_insert(partial(put_chunks, sources, chunk_size), database, num_workers, file_metadata,
+                         queue_depth, layout, len(sources), profile_dir, csv_parser)
+
+
+def stream_insert(feed, database=DATABASE, num_workers=os.cpu_count(), file_metadata=None,
+                  queue_depth=STREAM_QUEUE_DEPTH, layout='wide', num_files=None, profile_dir=None, csv_parser='csv'):
+    """
+    Like stream_insert_csvs(), but the TripSources are put on the parsers' queue by feed(file_queue), which
+    runs on a thread while this process writes. This lets files be parsed as soon as they become available,
+    e.g. once their download has finished. file_metadata may be filled in by feed as it goes, as long as a
+    file's entry is added before the file is put on the queue.
+    """
+    file_queue = multiprocessing.Queue()
+    batch_queue = multiprocessing.Queue(maxsize=queue_depth)
+
+    parsers = []
+    for parser_number in range(num_workers):
+        parser = multiprocessing.Process(target=_parse_csvs_to_queue, args=(
+            parser_number, file_queue, batch_queue, profile_dir, csv_parser))
+        parser.start()
+        parsers.append(parser)
+
+    feed_errors = []
+    feeder = threading.Thread(target=_feed_parsers, args=(feed, file_queue, num_workers, feed_errors))
+    feeder.start()
+
+    with bluebikes.metrics.profiled(profile_dir, 'writer'):
+        worker_stats = _write_batches_from_queue(batch_queue, len(parsers), num_files, database,
+                                                 file_metadata if file_metadata is not None else {}, layout)
+    feeder.join()
+    for parser in parsers:
+        parser.join()
+    if feed_errors:
+        raise feed_errors[0]
+    return worker_stats
+
+
+def put_chunks(sources, chunk_size, file_queue):
+    """
+    Puts the chunks of each source on the parsers' queue. Each file is split right before it is queued, so
+    parsing starts without waiting for the large files to be scanned.
+    """
+    for source in sources:
+        for chunk in bluebikes.sources.split_source(source, chunk_size):
+            file_queue.put(chunk)
+
+
+def _feed_parsers(feed, file_queue, num_parsers, feed_errors):
+    try:
+        feed(file_queue)
+    except Exception as e:
+        # the rows of the files fed so far are still written, the error is raised once the writer is done
+        feed_errors.append(e)
+    finally:
+        for _ in range(num_parsers):
+            file_queue.put(None)
+
+
+def _parse_csvs_to_queue(parser_number, file_queue, batch_queue, profile_dir=None, csv_parser='csv'):
+    """
+    Parser process: sends ('rows', file, columns, (start, first_line, batch)) for every batch, then ('done', ...)
+    or ('failed', ...) with (size, parse_seconds, chunk_count) for each file or chunk, and finally
+    ('finished', None, None, worker_stats) once there is no work left
+    """
+    stats = bluebikes.metrics.WorkerStats('parser', parser_number)
+    with bluebikes.metrics.profiled(profile_dir, 'parser-%s' % parser_number):
+        for source in iter(file_queue.get, None):
+            file = source.src_file
+            try:
+                # time spent waiting on the bounded queue isn't part of the cost of the file
+                parse_seconds = 0
+                row_count = 0
+                start = time.perf_counter()
+                for columns, data_to_insert, first_line in read_batches(source, True, csv_parser):
+                    parse_seconds += time.perf_counter() - start
+                    row_count += len(data_to_insert)
+                    batch_queue.put(('rows', file, columns, (source.start, first_line, data_to_insert)))
+                    start = time.perf_counter()
+                parse_seconds += time.perf_counter() - start
+                stats.add_file(file, row_count, source.size, parse_seconds)
+                batch_queue.put(('done', file, None, (source.size, parse_seconds, source.chunk_count)))
+            except Exception as e:
+                print("Failed to parse %s: %s" % (file, e))
+                batch_queue.put(('failed', file, None, (source.size, 0, source.chunk_count)))
+    batch_queue.put(('finished', None, None, stats.as_dict()))
+
+
+def _write_batches_from_queue(batch_queue, num_parsers, num_files, database, file_metadata, layout):
+    """
+    Returns the WorkerStats dicts of the parsers followed by that of the writer
+    """
+    stats = bluebikes.metrics.WorkerStats('writer')
+    worker_stats = []
+    conn = sqlite3.connect(database, timeout=DATABASE_LOCK_TIMEOUT, isolation_level=None)
+    _configure_sqlite_pragma(conn)
+    create_tables(conn, layout)
+    encoder = bluebikes.normalized.DictionaryEncoder(conn.cursor()) if layout == 'normalized' else None
+    loaded = {src_file for src_file, in conn.execute('SELECT src_file FROM bluebikes_manifest')}
+
+    row_counts = {}
+    reject_counts = {}
+    # (size, parse_seconds, chunks) of the chunks of each file that were parsed so far
+    parsed = {}
+    # rows of files that failed in another chunk are ignored
+    failed = set()
+    # files whose old rows were deleted in the open transaction. Committing is held off until they are
+    # complete so a reloaded month is never visible half loaded
+    replacing = set()
+    uncommitted_batches = 0
+    progress = tqdm(total=num_files, desc="Inserting files")
+
+    with stats.waiting_for_lock():
+        conn.execute('BEGIN IMMEDIATE')
+    while len(worker_stats) < num_parsers:
+        kind, file, columns, data_to_insert = batch_queue.get()
+        if kind == 'finished':
+            worker_stats.append(data_to_insert)
+            continue
+
+        if file not in row_counts:
+            row_counts[file] = 0
+            reject_counts[file] = 0
+            if file in loaded:
+                delete_src_file(conn, file, layout)
+                replacing.add(file)
+
+        if file in failed:
+            continue
+        if kind == 'rows':
+            start, first_line, rows = data_to_insert
+            if encoder is None:
+                insert_stmt, data_to_insert = bluebikes.sql.insert_stmt(columns), rows
+            else:
+                insert_stmt, data_to_insert = encoder.encode(columns, rows)
+            rejects = []
+            inserted = _bulk_insert(data_to_insert, insert_stmt, conn, rejects)
+            stats.add_batch(len(data_to_insert), inserted)
+            if rejects:
+                conn.executemany(bluebikes.sql.rejected_rows_insert,
+                                 _rejected_rows(file, start, first_line, rows, rejects))
+                reject_counts[file] += len(rejects)
+            row_counts[file] += inserted
+            uncommitted_batches += 1
+        elif kind == 'done':
+            size, parse_seconds, chunk_count = data_to_insert
+            parsed_size, parsed_seconds, parsed_chunks = parsed.get(file, (0, 0, 0))
+            parsed[file] = (parsed_size + size, parsed_seconds + parse_seconds, parsed_chunks + 1)
+            if parsed_chunks + 1 < chunk_count:
+                continue
+            s3_key, s3_size, s3_etag = file_metadata.get(file, (None, None, None))
+            conn.execute(bluebikes.sql.manifest_upsert, [file, s3_key, s3_size, s3_etag, row_counts[file]])
+            conn.execute(bluebikes.sql.load_stats_upsert, [file, parsed[file][0], row_counts[file], parsed[file][1]])
+            _print_rejects(file, reject_counts[file])
+            replacing.discard(file)
+            progress.update()
+        else:
+            # drop the file from the manifest and remove its partial rows to allow a clean retry
+            delete_src_file(conn, file, layout)
+            conn.execute('DELETE FROM bluebikes_manifest WHERE src_file = ?', [file])
+            failed.add(file)
+            replacing.discard(file)
+            progress.update()
+
+        if uncommitted_batches >= STREAM_COMMIT_INTERVAL and not replacing:
+            conn.execute('COMMIT')
+            with stats.waiting_for_lock():
+                conn.execute('BEGIN IMMEDIATE')
+            uncommitted_batches = 0
+
+    conn.execute('COMMIT')
+    progress.close()
+    conn.close()
+    return worker_stats + [stats.as_dict()]
+
+
+def create_tables(conn, layout='wide'):
+    _add_derived_columns(conn, layout)
+    conn.executescript(bluebikes.sql.normalized_create if layout == 'normalized' else bluebikes.sql.table_create)
+    conn.execute(bluebikes.sql.manifest_create)
+    conn.execute(bluebikes.sql.load_stats_create)
+    conn.execute(bluebikes.sql.rejected_rows_create)
+    conn.executescript(bluebikes.sql.rollups_create)
+
+
+def _add_derived_columns(conn, layout):
+    # databases of earlier versions are kept by --incremental and --resume
+    table = 'bluebikes_trips' if layout == 'normalized' else 'bluebikes'
+    # table_xinfo also lists generated columns
+    existing = [row[1] for row in conn.execute("SELECT * FROM pragma_table_xinfo(?)", [table])]
+    missing = [(name, column_type) for name, column_type in bluebikes.sql.derived_columns if name not in existing]
+    if not existing or not missing:
+        return
+    for name, column_type in missing:
+        conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, column_type))
+    if layout == 'normalized':
+        # recreated with the new columns
+        conn.execute('DROP VIEW IF EXISTS bluebikes')
+
+
+def drop_tables(conn):
+    """
+    Drops the trips, manifest, rejected rows and rollups of either layout
+    """
+    existing = conn.execute("SELECT type FROM sqlite_master WHERE name = 'bluebikes'").fetchone()
+    if existing is not None and existing[0] == 'table':
+        conn.execute(bluebikes.sql.table_drop)
+    conn.executescript(bluebikes.sql.normalized_drop)
+    conn.execute(bluebikes.sql.manifest_drop)
+    conn.execute(bluebikes.sql.rejected_rows_drop)
+    conn.executescript(bluebikes.sql.rollups_drop)
+
+
+def delete_src_file(conn, src_file, layout='wide'):
+    if layout == 'normalized':
+        conn.execute(bluebikes.sql.normalized_delete_src_file, [src_file])
+    else:
+        conn.execute('DELETE FROM bluebikes WHERE src_file = ?', [src_file])
+    conn.execute('DELETE FROM bluebikes_rejected_rows WHERE src_file = ?', [src_file])
+    bluebikes.rollups.delete_rollups(conn, src_file)
+
+
+def delete_partial_files(database=DATABASE, layout='wide'):
+    """
+    Removes what an interrupted import left of the files it was loading: rows of files missing from the
+    manifest, or whose row count doesn't match the one recorded with their manifest entry. Their manifest
+    entries are removed too, so they are loaded again. Returns the src_files that were removed.
+    """
+    conn = sqlite3.connect(database, timeout=DATABASE_LOCK_TIMEOUT, isolation_level=None)
+    create_tables(conn, layout)
+    manifest = dict(conn.execute('SELECT src_file, row_count FROM bluebikes_manifest'))
+    row_counts = dict(conn.execute('SELECT src_file, COUNT(*) FROM bluebikes GROUP BY src_file'))
+    partial_files = sorted(src_file for src_file in set(manifest) | set(row_counts)
+                           if row_counts.get(src_file, 0) != manifest.get(src_file))
+    conn.execute('BEGIN IMMEDIATE')
+    for src_file in partial_files:
+        delete_src_file(conn, src_file, layout)
+        conn.execute('DELETE FROM bluebikes_manifest WHERE src_file = ?', [src_file])
+    conn.execute('COMMIT')
+    conn.close()
+    return partial_files
+
+
+def max_id(database=DATABASE):
+    conn = sqlite3.connect(database, isolation_level=None)
+    conn.execute(bluebikes.sql.table_create)
+    result = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bluebikes").fetchone()[0]
+    conn.close()
+    return result
+
+
+def load_manifest(database=DATABASE):
+    """
+    Returns {src_file: (s3_key, s3_size, s3_etag)} for every CSV previously loaded into the database
+    """
+    conn = sqlite3.connect(database, isolation_level=None)
+    conn.execute(bluebikes.sql.manifest_create)
+    rows = conn.execute("SELECT src_file, s3_key, s3_size, s3_etag FROM bluebikes_manifest").fetchall()
+    conn.close()
+    return {src_file: (s3_key, s3_size, s3_etag) for src_file, s3_key, s3_size, s3_etag in rows}
+
+
+def print_csv_header(file):
+    """
+    Helper function to print the first line of a CSV file. Useful for schema debugging
+    """
+    source = bluebikes.sources.as_source(file)
+    with bluebikes.sources.open_source(source) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='|')
+        for row in reader:
+            print((source.src_file, row))
+            return
+
+
+def _insert_rows_from_single_csv(source, cursor, stats=None, rejected_rows=None, csv_parser='csv'):
+    """
+    Returns the number of rows inserted, or None when the file couldn't be read, e.g. because its layout
+    isn't recognized. Rejected rows are counted in the optional WorkerStats and appended to the optional
+    rejected_rows list as bluebikes_rejected_rows.
+    """
+    row_count = 0
+    try:
+        for columns, data_to_insert, first_line in read_batches(source, True, csv_parser):
+            rejects = []
+            inserted = _bulk_insert(data_to_insert, bluebikes.sql.insert_stmt(columns), cursor, rejects)
+            if stats is not None:
+                stats.add_batch(len(data_to_insert), inserted)
+            if rejected_rows is not None:
+                rejected_rows += _rejected_rows(source.src_file, source.start, first_line, data_to_insert, rejects)
+            row_count += inserted
+    except ValueError as e:
+        print("Skipping %s: %s" % (source.src_file, e))
+        return None
+    return row_count
+
+
+def read_batches(file, with_lines=False, csv_parser='csv'):
+    """
+    Yields (columns, rows) for batches of up to BULK_INSERT_SIZE rows of a TripSource or CSV path.
+    The row layout is compiled once from the header of the file. With with_lines, (columns, rows, first_line)
+    is yielded instead, where first_line is the line number of the first row counted from the start of
+    the source. csv_parser is one of CSV_PARSERS, both give the same batches.
+    """
+    source = bluebikes.sources.as_source(file)
+    batches = _read_arrow_batches(source) if csv_parser == 'arrow' else _read_csv_batches(source)
+    for columns, data_to_insert, first_line in batches:
+        if with_lines:
+            yield columns, data_to_insert, first_line
+        else:
+            yield columns, data_to_insert
+
+
+def _read_csv_batches(source):
+    with bluebikes.sources.open_source(source) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        # chunks after the first line of a file come with its header
+        header = source.header or next(reader, None)
+        if header is None:
+            return
+        adapter = bluebikes.schema.adapter_for_header(header, source.src_file)
+
+        while True:
+            first_line = reader.line_num + 1
+            rows = list(islice(reader, BULK_INSERT_SIZE))
+            if not rows:
+                break
+            try:
+                data_to_insert = adapter.adapt(rows)
+            except IndexError as e:
+                # a row with too few fields, the whole batch is dropped
+                print(e)
+                continue
+            yield adapter.columns, data_to_insert, first_line
+
+
+def _read_arrow_batches(source):
+    """
+    Parses the source in blocks with pyarrow's CSV reader, which splits and converts the fields in C++.
+    The values stay strings like those of the csv module, and the rows are zipped from the columns of each
+    batch. Line numbers assume no field spans lines.
+    """
+    pyarrow, pyarrow_csv = _import_pyarrow_csv()
+    with bluebikes.sources.open_source_bytes(source) as f:
+        header = source.header
+        first_line = 1
+        if header is None:
+            header_line = f.readline()
+            if not header_line:
+                return
+            header = next(csv.reader([header_line.decode()]))
+            first_line = 2
+        adapter = bluebikes.schema.adapter_for_header(header, source.src_file)
+
+        # headers can repeat names, so the columns are numbered instead
+        column_names = ['c%s' % i for i in range(len(header))]
+        reader = pyarrow_csv.open_csv(
+            f,
+            # the workers are processes already
+            read_options=pyarrow_csv.ReadOptions(column_names=column_names, block_size=ARROW_BLOCK_SIZE,
+                                                 use_threads=False),
+            parse_options=pyarrow_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=_skip_invalid_row),
+            convert_options=pyarrow_csv.ConvertOptions(column_types={name: pyarrow.string() for name in column_names}))
+        # blocks end anywhere, the rows are regrouped into batches of BULK_INSERT_SIZE like those of the csv parser
+        rows = []
+        for record_batch in reader:
+            columns = {i: record_batch.column(i).to_pylist() for i in set(adapter.indexes)}
+            rows += adapter.adapt_columns(columns, record_batch.num_rows)
+            while len(rows) >= BULK_INSERT_SIZE:
+                yield adapter.columns, rows[:BULK_INSERT_SIZE], first_line
+                rows = rows[BULK_INSERT_SIZE:]
+                first_line += BULK_INSERT_SIZE
+        if rows:
+            yield adapter.columns, rows, first_line
+
+
+def _skip_invalid_row(row):
+    # a row with too few or too many fields
+    print("Skipping line %s: %s" % (row.number, row.text))
+    return 'skip'
+
+
+def _import_pyarrow_csv():
+    try:
+        import pyarrow
+        import pyarrow.csv
+    except ImportError:
+        raise ImportError("The arrow parser requires pyarrow, install it with `pip install pyarrow`")
+    return pyarrow, pyarrow.csv
+
+
+def _bulk_insert(data_to_insert, insert_stmt, cursor, rejects=None, first=0):
+    """
+    Returns the number of rows inserted. A batch that fails is rolled back and retried in halves, so only the
+    rows that fail on their own are left out. Their (index in the batch, error) are appended to the optional
+    rejects list, or printed without one.
+    """
+    cursor.execute('SAVEPOINT bulk_insert')
+    try:
+        cursor.executemany(insert_stmt, data_to_insert)
+        cursor.execute('RELEASE bulk_insert')
+        return len(data_to_insert)
+    except Exception as e:
+        cursor.execute('ROLLBACK TO bulk_insert')
+        cursor.execute('RELEASE bulk_insert')
+        if len(data_to_insert) > 1:
+            half = len(data_to_insert) // 2
+            return (_bulk_insert(data_to_insert[:half], insert_stmt, cursor, rejects, first) +
+                    _bulk_insert(data_to_insert[half:], insert_stmt, cursor, rejects, first + half))
+        if rejects is None:
+            print(e)
+        else:
+            rejects.append((first, str(e)))
+        return 0
+
+
+def _rejected_rows(src_file, start, first_line, data_to_insert, rejects):
+    """
+    Returns the bluebikes_rejected_rows of the rejects of a batch starting at first_line of the source
+    """
+    # numpy values of derived columns aren't JSON serializable
+    return [(src_file, start or 0, first_line + index, error,
+             json.dumps(list(data_to_insert[index]), default=str)) for index, error in rejects]
+
+
+def _print_rejects(src_file, reject_count):
+    if reject_count:
+        print("Rejected %s rows of %s, see bluebikes_rejected_rows" % (reject_count, src_file))
+
+
+def _initialize_in_memory_database(worker_number, id_offset=0, max_memory_bytes=None):
+    """
+    With max_memory_bytes this is a private temporary database instead, which SQLite keeps in its page cache
+    until it reaches that size and then spills to a temporary file that is removed when it is closed
+    """
+    if max_memory_bytes is None:
+        memory_conn = sqlite3.connect(':memory:', timeout=DATABASE_LOCK_TIMEOUT, isolation_level=None)
+    else:
+        memory_conn = sqlite3.connect('', timeout=DATABASE_LOCK_TIMEOUT, isolation_level=None)
+        # a negative cache size is in KiB
+        memory_conn.execute("PRAGMA cache_size = -%s" % max(1, max_memory_bytes // 1024))
+    _configure_sqlite_pragma(memory_conn, "memory")
+    cursor = memory_conn.cursor()
+    cursor.execute(bluebikes.sql.table_create)
+    _seed_auto_increment(cursor, worker_number, id_offset)
+
+    return memory_conn, cursor
+
+
+def _configure_sqlite_pragma(connection, journal_mode="WAL"):
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA journal_mode = %s" % journal_mode)
+    connection.execute('PRAGMA busy_timeout = %s' % (DATABASE_LOCK_TIMEOUT * 1000))
+
+
+def _seed_auto_increment(cursor, worker_number, id_offset=0):
+    """
+    This insert will seed the auto-increment primary key at a value related to the worker number.
+    This is required to avoid ID collisions when dumping the in-memory database into the file.
+    The offset keeps incremental loads clear of the ids inserted by previous runs.
+    It will be deleted immediately.
+    """
+    auto_increment_start_id = id_offset + worker_number * 100000000
+    cursor.execute(bluebikes.sql.id_insert, [auto_increment_start_id])
+    cursor.execute("delete from bluebikes where rowid=?", [auto_increment_start_id])
+
+
+def _dump_memory_db_to_file(memory_conn, files, database=DATABASE, file_metadata=None, load_stats=(), stats=None,
+                            rejected_rows=()):
+    """
+    Insert data from the in-memory table to the file-based table.
+    Rows from a previous load of the same files are replaced and the manifest is updated in the same
+    transaction, so a changed month is never visible half loaded.
+    load_stats are (src_file, size, row_count, seconds) tuples for bluebikes_load_stats. The time spent
+    waiting for the other workers to release the write lock is added to the optional WorkerStats.
+    rejected_rows replace those of a previous load of the files in bluebikes_rejected_rows.
+    """
+    file_metadata = file_metadata or {}
+    file_conn = sqlite3.connect(database, timeout=DATABASE_LOCK_TIMEOUT, isolation_level=None)
+    _configure_sqlite_pragma(file_conn)
+    file_conn.execute(bluebikes.sql.manifest_create)
+    file_conn.execute(bluebikes.sql.load_stats_create)
+    file_conn.execute(bluebikes.sql.rejected_rows_create)
+    memory_conn.execute('ATTACH DATABASE "%s" AS filedb' % database)
+    row_counts = dict(memory_conn.execute('SELECT src_file, COUNT(*) FROM bluebikes GROUP BY src_file'))
+
+    stats = stats or bluebikes.metrics.WorkerStats('memory')
+    with stats.waiting_for_lock():
+        memory_conn.execute('BEGIN IMMEDIATE')
+    for f in files:
+        # only previously loaded files can have rows to delete, which avoids a table scan for new months
+        loaded = memory_conn.execute('SELECT 1 FROM filedb.bluebikes_manifest WHERE src_file = ?', [f]).fetchone()
+        if loaded:
+            memory_conn.execute('DELETE FROM filedb.bluebikes WHERE src_file = ?', [f])
+        memory_conn.execute('DELETE FROM filedb.bluebikes_rejected_rows WHERE src_file = ?', [f])
+        s3_key, s3_size, s3_etag = file_metadata.get(f, (None, None, None))
+        # the in-memory database has no manifest table, so this resolves to filedb.bluebikes_manifest
+        memory_conn.execute(bluebikes.sql.manifest_upsert, [f, s3_key, s3_size, s3_etag, row_counts.get(f, 0)])
+    # like the manifest, this resolves to filedb.bluebikes_load_stats
+    memory_conn.executemany(bluebikes.sql.load_stats_upsert, load_stats)
+    memory_conn.executemany(bluebikes.sql.rejected_rows_insert, rejected_rows)
+    # generated columns are part of SELECT * but can't be inserted
+    columns = _stored_columns(memory_conn)
+    memory_conn.execute('INSERT INTO filedb.bluebikes (%s) SELECT %s FROM bluebikes' % (columns, columns))
+    memory_conn.execute('COMMIT')
+
+    memory_conn.execute('DETACH DATABASE filedb')
+    file_conn.close()
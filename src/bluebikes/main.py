@@ -1,60 +1,312 @@
-import argparse
-import os
-import sqlite3
-import shutil
-
-from bluebikes import sql
-from bluebikes import insert
-from bluebikes import download
-
-from tqdm.contrib.concurrent import process_map
-
-
-def main_cli():
-    parser = argparse.ArgumentParser(description="Download Blue Bikes data as CSV files, then load them into a SQLite Database called bluebike.sqlite")
-    parser.add_argument("-d", "--data_dir", default="data/raw",
-                    help="A folder to store Blue Bikes CSV files downloaded from the S3 bucket. Defaults to 'data'."
-                    )
-    parser.add_argument("--no_cleanup", action="store_true", 
-                    help="By default, the folder where CSV files will be deleted at the end."\
-                          "Use this flag if you don't want to deleted them. This is useful for debugging purposes.")
-    parser.add_argument("--download_only", action="store_true",
-                    help="Only download the files from S3, useful for layering within docker")
-    parser.add_argument("--insert_only", action="store_true",
-                    help="Only attempt to insert records from files already download. Will fail if no files are found")
-    args = parser.parse_args()
-    main(args.data_dir, not args.no_cleanup, args.download_only, args.insert_only)
-
-
-def main(data_dir, is_cleanup_downloads=True, download_only=False, insert_only=False):
-    worker_count = os.cpu_count()
-
-    if insert_only:
-        print("Running in insert_only mode. Skipping downloading of files from S3")
-    else:
-        # create the temporary directory for storing the zip files and CSVs
-        os.makedirs(data_dir, exist_ok=True)
-        download.download_and_extract(worker_count, data_dir)
-
-    if download_only:
-        print("Running in download_only mode. Skipping insert of files")
-        return
-
-    print("==== Recreating database ====")
-    # drop and recreate the table in the db file before inserting the records
-    db = sqlite3.connect(insert.DATABASE, isolation_level=None)
-    db.execute(sql.table_drop)
-    db.execute(sql.table_create)
-    db.close()
-
-    print("==== Inserting with %s workers ====" % worker_count)
-    distribution = insert.evenly_distribute_csv_files_for_insert_by_total_size(worker_count, data_dir)
-    process_map(insert.insert_rows_from_list_of_csvs, distribution.items(), [insert.DATABASE] * len(distribution) , max_workers=worker_count)
-
-    # clean up all downloaded data to reduce the size of the docker image
-    if is_cleanup_downloads:
-        shutil.rmtree(data_dir)
-
-
-if __name__ == '__main__':
-    main_cli()
+import argparse
+import os
+import sqlite3
+import shutil
+
+from bluebikes import insert
+from bluebikes import download
+from bluebikes import export
+from bluebikes import finalize
+from bluebikes import metrics
+from bluebikes import pipeline
+from bluebikes import rollups
+from bluebikes import sources
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Download Blue Bikes data as CSV files, then load them into a SQLite Database called bluebike.sqlite")
+    parser.add_argument("-d", "--data_dir", default="data/raw",
+                    help="A folder to store Blue Bikes CSV files downloaded from the S3 bucket. Defaults to 'data'."
+                    )
+    parser.add_argument("--no_cleanup", action="store_true",
+                    help="By default, the folder where CSV files will be deleted at the end."\
+                          "Use this flag if you don't want to deleted them. This is useful for debugging purposes.")
+    parser.add_argument("--download_only", action="store_true",
+                    help="Only download the files from S3, useful for layering within docker")
+    parser.add_argument("--insert_only", action="store_true",
+                    help="Only attempt to insert records from files already download. Will fail if no files are found")
+    parser.add_argument("--incremental", action="store_true",
+                    help="Keep the existing database and only download and insert monthly files that are new "\
+                         "or have changed in S3 since they were last loaded")
+    parser.add_argument("--resume", action="store_true",
+                    help="Continue an interrupted import: keep the existing database, remove the rows of files "\
+                         "that were only partially loaded and only insert the files that aren't fully loaded yet")
+    parser.add_argument("--insert_strategy", choices=insert.INSERT_STRATEGIES, default="memory",
+                    help="'memory' loads each worker's files into its own in-memory database before copying it into "\
+                         "the file. 'stream' has the workers send small batches to a single writer, which bounds "\
+                         "memory use. 'shards' has each worker write its own shard file, which are merged into "\
+                         "the database in month order at the end. Defaults to 'memory'.")
+    parser.add_argument("--csv_parser", choices=insert.CSV_PARSERS, default="csv",
+                    help="'csv' parses the trip files row by row with Python's csv module. 'arrow' parses blocks of "\
+                         "rows with pyarrow's CSV reader, which is faster but requires pyarrow. Defaults to 'csv'.")
+    parser.add_argument("--layout", choices=insert.LAYOUTS, default="wide",
+                    help="'normalized' stores stations, source files, user types and rideable types once in "\
+                         "dimension tables and presents them through a bluebikes view, which takes much less "\
+                         "disk space. Requires --insert_strategy stream. Defaults to 'wide'.")
+    parser.add_argument("--indexes", nargs="*", choices=finalize.DEFAULT_INDEXES, default=finalize.DEFAULT_INDEXES,
+                    help="Indexes to build once all rows are inserted. Pass the flag without names to skip "\
+                         "building indexes. Defaults to all of them.")
+    parser.add_argument("--parquet_dir",
+                    help="Also write the parsed trips as Parquet files partitioned by year and month to this folder. "\
+                         "Requires pyarrow.")
+    parser.add_argument("--skip_rollups", action="store_true",
+                    help="Don't build the per station hourly/daily and origin-destination monthly trip counts")
+    parser.add_argument("--pipeline", action="store_true",
+                    help="Start parsing and inserting each archive as soon as it is downloaded instead of waiting "\
+                         "for every download to finish. Requires --insert_strategy stream.")
+    parser.add_argument("--bucket_dir",
+                    help="Download from a local copy of the bucket in this folder instead of S3, e.g. for testing "\
+                         "or benchmarking without network access")
+    parser.add_argument("--report",
+                    help="Write a JSON report with the duration of every stage, rows/s per file and worker, peak "\
+                         "memory per worker and the time spent waiting for database locks to this file")
+    parser.add_argument("--profile",
+                    help="Write cProfile stats of every worker process to this folder, to be read with "\
+                         "`python -m pstats`")
+    parser.add_argument("--max_memory", type=int,
+                    help="Memory budget in MB shared by the insert workers. Limits how many workers run at once, "\
+                         "and with the memory strategy how much of its database each worker keeps in memory "\
+                         "before spilling it to a temporary file. Defaults to no limit.")
+    args = parser.parse_args()
+    if args.layout == "normalized" and args.insert_strategy != "stream":
+        parser.error("--layout normalized requires --insert_strategy stream")
+    if args.pipeline and args.insert_strategy != "stream":
+        parser.error("--pipeline requires --insert_strategy stream")
+    if args.pipeline and (args.download_only or args.insert_only):
+        parser.error("--pipeline can't be combined with --download_only or --insert_only")
+    if args.resume and (args.incremental or args.pipeline):
+        parser.error("--resume can't be combined with --incremental or --pipeline, which resume by themselves")
+    main(args.data_dir, not args.no_cleanup, args.download_only, args.insert_only, args.incremental,
+         args.insert_strategy, args.layout, args.indexes, args.parquet_dir, not args.skip_rollups, args.bucket_dir,
+         args.pipeline, args.report, args.profile, args.max_memory, args.resume, args.csv_parser)
+
+
+def main(data_dir, is_cleanup_downloads=True, download_only=False, insert_only=False, incremental=False,
+         insert_strategy="memory", layout="wide", indexes=finalize.DEFAULT_INDEXES, parquet_dir=None,
+         build_rollups=True, bucket_dir=None, pipelined=False, report_path=None, profile_dir=None,
+         max_memory=None, resume=False, csv_parser="csv"):
+    if layout == "normalized" and insert_strategy != "stream":
+        # dictionary encoding relies on a single writer owning the dimension tables
+        raise ValueError("The normalized layout requires the stream insert strategy")
+    if pipelined and insert_strategy != "stream":
+        raise ValueError("The pipeline requires the stream insert strategy")
+    worker_count = os.cpu_count()
+    run_report = metrics.RunReport()
+
+    if pipelined:
+        csv_files = _pipelined_download_and_insert(data_dir, incremental, layout, bucket_dir, worker_count,
+                                                   run_report, profile_dir, max_memory, csv_parser)
+    else:
+        csv_files = _download_then_insert(data_dir, download_only, insert_only, incremental, insert_strategy, layout,
+                                          bucket_dir, worker_count, run_report, profile_dir, max_memory, resume,
+                                          csv_parser)
+    if csv_files is None:
+        _write_report(run_report, report_path)
+        return
+
+    print("==== Building indexes ====")
+    with run_report.stage('finalize', indexes=list(indexes)):
+        finalize.finalize(insert.DATABASE, indexes, layout)
+
+    if build_rollups:
+        print("==== Building rollups ====")
+        with run_report.stage('rollups', files=len(csv_files)):
+            rollups.refresh_rollups(insert.DATABASE, [source.src_file for source in csv_files])
+
+    if parquet_dir is not None:
+        print("==== Exporting %s files to parquet ====" % len(csv_files))
+        with run_report.stage('export', files=len(csv_files)):
+            export.export_parquet(csv_files, parquet_dir, worker_count)
+
+    # clean up all downloaded data to reduce the size of the docker image
+    if is_cleanup_downloads:
+        shutil.rmtree(data_dir)
+    _write_report(run_report, report_path)
+
+
+def _write_report(run_report, report_path):
+    if report_path is not None:
+        run_report.write(report_path)
+        print("==== Wrote run report to %s ====" % report_path)
+
+
+def _download_then_insert(data_dir, download_only, insert_only, incremental, insert_strategy, layout, bucket_dir,
+                          worker_count, run_report, profile_dir, max_memory, resume, csv_parser):
+    """
+    Runs the download and insert stages one after the other. Returns the loaded TripSources, or None when
+    nothing was inserted. When resuming, every TripSource is returned so the indexes and rollups the
+    interrupted run didn't get to are built.
+    """
+    if insert_only:
+        print("Running in insert_only mode. Skipping downloading of files from S3")
+    else:
+        # create the temporary directory for storing the zip files and CSVs
+        os.makedirs(data_dir, exist_ok=True)
+        bucket = download.S3Bucket() if bucket_dir is None else download.LocalBucket(bucket_dir)
+        s3_files = download.list_bucket(bucket)
+        if incremental:
+            s3_files = changed_s3_objects(s3_files, insert.load_manifest(insert.DATABASE))
+            print("Running in incremental mode. %s new or changed files in S3" % len(s3_files))
+        with run_report.stage('download', objects=len(s3_files)) as stage:
+            stage['bytes'] = download.download_files(data_dir, s3_files, bucket)
+
+    if download_only:
+        print("Running in download_only mode. Skipping insert of files")
+        return None
+
+    listing = download.read_listing(data_dir)
+    file_metadata = {csv_file: (s3_key, info['size'], info['etag'])
+                     for s3_key, info in listing.items() for csv_file in info['members']}
+
+    # the CSVs are read straight out of the downloaded archives
+    found_sources = {source.src_file: source for source in sources.find_sources(data_dir)}
+
+    if incremental:
+        db = sqlite3.connect(insert.DATABASE, isolation_level=None)
+        insert.create_tables(db, layout)
+        db.close()
+        insert.delete_partial_files(insert.DATABASE, layout)
+        manifest = insert.load_manifest(insert.DATABASE)
+        changed_objects = changed_s3_objects([(k, v['size'], v['etag']) for k, v in listing.items()], manifest)
+        src_files = [csv_file for s3_key, _, _ in changed_objects for csv_file in listing[s3_key]['members']]
+        # CSVs without any S3 metadata are loaded once, when they are missing from the manifest
+        src_files += [src_file for src_file in found_sources
+                      if src_file not in file_metadata and src_file not in manifest]
+        csv_files = [found_sources[src_file] for src_file in src_files if src_file in found_sources]
+        if not csv_files:
+            print("==== Database is up to date ====")
+            return None
+        _delete_stale_files(insert.DATABASE, manifest, changed_objects, src_files, layout)
+    elif resume:
+        partial_files = insert.delete_partial_files(insert.DATABASE, layout)
+        manifest = insert.load_manifest(insert.DATABASE)
+        csv_files = [source for src_file, source in found_sources.items() if src_file not in manifest]
+        print("==== Resuming with %s files left to insert, %s of them partially loaded ====" % (
+            len(csv_files), len(partial_files)))
+        _insert(csv_files, insert_strategy, layout, file_metadata, worker_count, run_report, profile_dir, max_memory,
+                csv_parser)
+        return list(found_sources.values())
+    else:
+        print("==== Recreating database ====")
+        # drop and recreate the table in the db file before inserting the records
+        db = sqlite3.connect(insert.DATABASE, isolation_level=None)
+        insert.drop_tables(db)
+        insert.create_tables(db, layout)
+        db.close()
+        csv_files = list(found_sources.values())
+
+    _insert(csv_files, insert_strategy, layout, file_metadata, worker_count, run_report, profile_dir, max_memory,
+            csv_parser)
+    return csv_files
+
+
+def _insert(csv_files, insert_strategy, layout, file_metadata, worker_count, run_report, profile_dir, max_memory,
+            csv_parser):
+    if not csv_files:
+        return
+    if insert_strategy == "stream":
+        parser_count, queue_depth = _stream_workers(worker_count, max_memory)
+        print("==== Streaming %s files from %s parsers to one writer ====" % (len(csv_files), parser_count))
+        with run_report.stage('insert', files=len(csv_files), bytes=sum(f.size for f in csv_files)):
+            run_report.add_workers(insert.stream_insert_csvs(csv_files, insert.DATABASE, parser_count, file_metadata,
+                                                             queue_depth, layout, profile_dir=profile_dir,
+                                                             csv_parser=csv_parser))
+    else:
+        max_database_bytes = None
+        if max_memory is not None:
+            worker_count, max_database_bytes = insert.memory_worker_budget(max_memory, worker_count)
+            print("==== Each worker keeps up to %sMB of rows in memory ====" % (max_database_bytes // 1024 // 1024))
+        print("==== Inserting %s files with %s workers ====" % (len(csv_files), worker_count))
+        with run_report.stage('insert', files=len(csv_files), bytes=sum(f.size for f in csv_files)):
+            if insert_strategy == "shards":
+                run_report.add_workers(insert.shard_insert_csvs(csv_files, insert.DATABASE, worker_count,
+                                                                file_metadata, profile_dir, max_database_bytes,
+                                                                csv_parser))
+            else:
+                id_offset = insert.max_id(insert.DATABASE)
+                run_report.add_workers(insert.memory_insert_csvs(csv_files, insert.DATABASE, worker_count,
+                                                                 file_metadata, id_offset, profile_dir,
+                                                                 max_database_bytes, csv_parser=csv_parser))
+
+
+def _pipelined_download_and_insert(data_dir, incremental, layout, bucket_dir, worker_count, run_report, profile_dir,
+                                   max_memory, csv_parser):
+    """
+    Inserts each archive as soon as its download finishes. Returns the loaded TripSources, or None when
+    nothing was inserted
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    bucket = download.S3Bucket() if bucket_dir is None else download.LocalBucket(bucket_dir)
+    s3_files = download.list_bucket(bucket)
+    db = sqlite3.connect(insert.DATABASE, isolation_level=None)
+    if incremental:
+        insert.create_tables(db, layout)
+        insert.delete_partial_files(insert.DATABASE, layout)
+        manifest = insert.load_manifest(insert.DATABASE)
+        s3_files = changed_s3_objects(s3_files, manifest)
+        print("Running in incremental mode. %s new or changed files in S3" % len(s3_files))
+    else:
+        print("==== Recreating database ====")
+        insert.drop_tables(db)
+        insert.create_tables(db, layout)
+    db.close()
+    if not s3_files:
+        print("==== Database is up to date ====")
+        return None
+
+    parser_count, queue_depth = _stream_workers(worker_count, max_memory)
+    print("==== Streaming %s downloads to %s parsers and one writer ====" % (len(s3_files), parser_count))
+    with run_report.stage('download_and_insert', objects=len(s3_files), bytes=sum(size for _, size, _ in s3_files)):
+        csv_files, worker_stats = pipeline.download_and_insert(data_dir, s3_files, bucket, insert.DATABASE,
+                                                               parser_count, layout, queue_depth=queue_depth,
+                                                               profile_dir=profile_dir, csv_parser=csv_parser)
+    run_report.add_workers(worker_stats)
+    if incremental:
+        _delete_stale_files(insert.DATABASE, manifest, s3_files, [source.src_file for source in csv_files], layout)
+    return csv_files
+
+
+def _stream_workers(worker_count, max_memory):
+    """
+    Returns the number of parsers and the queue depth for the stream strategy
+    """
+    # this process is the writer, leave it a core
+    parser_count = max(1, worker_count - 1)
+    if max_memory is None:
+        return parser_count, insert.STREAM_QUEUE_DEPTH
+    return insert.stream_worker_budget(max_memory, parser_count)
+
+
+def changed_s3_objects(s3_files, manifest):
+    """
+    Filters (key, size, etag) S3 objects down to the trip archives that are missing from the
+    manifest or whose size or ETag no longer matches what was loaded
+    """
+    loaded = {}
+    for s3_key, s3_size, s3_etag in manifest.values():
+        loaded.setdefault(s3_key, set()).add((s3_size, s3_etag))
+
+    return [(s3_key, size, etag) for s3_key, size, etag in s3_files
+            if s3_key.endswith('.zip') and loaded.get(s3_key) != {(size, etag)}]
+
+
+def _delete_stale_files(database, manifest, changed_objects, src_files, layout):
+    """
+    Remove rows of CSVs that a changed archive no longer contains, e.g. after a rename
+    """
+    changed_keys = {s3_key for s3_key, _, _ in changed_objects}
+    stale = [src_file for src_file, (s3_key, _, _) in manifest.items()
+             if s3_key in changed_keys and src_file not in src_files]
+    if not stale:
+        return
+    db = sqlite3.connect(database, isolation_level=None)
+    db.execute('BEGIN IMMEDIATE')
+    for src_file in stale:
+        insert.delete_src_file(db, src_file, layout)
+        db.execute('DELETE FROM bluebikes_manifest WHERE src_file = ?', [src_file])
+    db.execute('COMMIT')
+    db.close()
+
+
+if __name__ == '__main__':
+    main_cli()
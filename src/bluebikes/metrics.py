@@ -0,0 +1,132 @@
+import cProfile
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+
+def peak_rss_mb():
+    """
+    High-water mark of the resident memory of this process
+    """
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class WorkerStats:
+    """
+    Counters of one memory worker, stream parser or stream writer. Workers send as_dict() to the main
+    process once they are done, where it becomes part of the RunReport.
+    """
+
+    def __init__(self, role, number=0):
+        self.role = role
+        self.number = number
+        self.files = []
+        self.rejected_rows = 0
+        self.lock_wait_seconds = 0
+        self._start = time.perf_counter()
+
+    def add_file(self, src_file, rows, size, seconds, rejected_rows=0):
+        self.files.append({'src_file': src_file, 'rows': rows, 'bytes': size, 'seconds': seconds,
+                           'rejected_rows': rejected_rows})
+
+    def add_batch(self, batch_size, inserted):
+        self.rejected_rows += batch_size - inserted
+
+    @contextmanager
+    def waiting_for_lock(self):
+        start = time.perf_counter()
+        yield
+        self.lock_wait_seconds += time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            'worker': '%s-%s' % (self.role, self.number),
+            'pid': os.getpid(),
+            'seconds': time.perf_counter() - self._start,
+            'files': self.files,
+            'rows': sum(f['rows'] for f in self.files),
+            'bytes': sum(f['bytes'] for f in self.files),
+            'rejected_rows': self.rejected_rows,
+            'lock_wait_seconds': self.lock_wait_seconds,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+
+class RunReport:
+    """
+    Collects the stage durations of a run and the stats of its workers into a JSON report
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.workers = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, **counters):
+        """
+        Times the block. Counters like bytes or files can be passed, or set on the yielded dict.
+        """
+        entry = dict(name=name, **counters)
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = time.perf_counter() - start
+            self.stages.append(entry)
+
+    def add_workers(self, worker_stats):
+        self.workers.extend(worker_stats or [])
+
+    def as_dict(self):
+        files = {}
+        for worker in self.workers:
+            for f in worker['files']:
+                # chunks of one file can be parsed by different workers
+                entry = files.setdefault(f['src_file'], {'src_file': f['src_file'], 'rows': 0, 'bytes': 0,
+                                                         'seconds': 0, 'rejected_rows': 0, 'workers': []})
+                entry['rows'] += f['rows']
+                entry['rejected_rows'] += f.get('rejected_rows', 0)
+                entry['bytes'] += f['bytes']
+                entry['seconds'] += f['seconds']
+                entry['workers'].append(worker['worker'])
+        for entry in files.values():
+            entry['rows_per_sec'] = _rate(entry['rows'], entry['seconds'])
+        workers = [dict(worker, rows_per_sec=_rate(worker['rows'], worker['seconds'])) for worker in self.workers]
+        return {
+            'seconds': time.perf_counter() - self._start,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': self.stages,
+            'workers': workers,
+            'files': sorted(files.values(), key=lambda x: x['src_file']),
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+def _rate(rows, seconds):
+    return rows / seconds if seconds else None
+
+
+@contextmanager
+def profiled(profile_dir, name):
+    """
+    Runs the block under cProfile and writes the stats to profile_dir/<name>-<pid>.pstats, for
+    `python -m pstats`. Does nothing when profile_dir is None.
+    """
+    if profile_dir is None:
+        yield
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(os.path.join(profile_dir, '%s-%s.pstats' % (name, os.getpid())))
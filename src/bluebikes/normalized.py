@@ -0,0 +1,80 @@
+from operator import itemgetter
+
+import bluebikes.sql
+
+# columns of the wide layout that are replaced by keys of a dimension table in the normalized layout
+DIMENSION_COLUMNS = ['src_file', 'start_id', 'start_station_name', 'end_id', 'end_station_name', 'usertype',
+                     'rideable_type']
+KEY_COLUMNS = ['file_key', 'start_station_key', 'end_station_key', 'usertype_key', 'rideable_type_key']
+
+
+class DictionaryEncoder:
+    """
+    Replaces the repeated strings of wide rows with integer keys of the dimension tables.
+    Keys are cached in memory so only values that haven't been seen yet touch the database.
+    The encoder must be used by the only connection writing to the dimension tables.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._files = {}
+        self._stations = {}
+        self._usertypes = {}
+        self._rideable_types = {}
+        self._plans = {}
+
+    def encode(self, columns, rows):
+        """
+        Returns (insert_stmt, rows) for the bluebikes_trips table from rows holding the given wide columns
+        """
+        plan = self._plans.get(columns)
+        if plan is None:
+            plan = self._plans[columns] = self._compile(columns)
+        insert_stmt, project, f, start_id, start_name, end_id, end_name, u, r = plan
+
+        files, stations, usertypes, rideable_types = self._files, self._stations, self._usertypes, self._rideable_types
+        encoded = []
+        for row in rows:
+            start = (row[start_id], row[start_name])
+            end = (row[end_id], row[end_name])
+            rideable_type = row[r] if r is not None else None
+            encoded.append(project(row) + (
+                files.get(row[f]) or self._file_key(row[f]),
+                stations.get(start) or self._station_key(start),
+                stations.get(end) or self._station_key(end),
+                usertypes.get(row[u]) or self._usertype_key(row[u]),
+                (None if rideable_type is None else
+                 rideable_types.get(rideable_type) or self._rideable_type_key(rideable_type)),
+            ))
+        return insert_stmt, encoded
+
+    def _compile(self, columns):
+        passthrough = [column for column in columns if column not in DIMENSION_COLUMNS]
+        insert_stmt = bluebikes.sql.normalized_insert_stmt(passthrough + KEY_COLUMNS)
+        project = itemgetter(*[columns.index(column) for column in passthrough])
+        rideable_type = columns.index('rideable_type') if 'rideable_type' in columns else None
+        return (insert_stmt, project, columns.index('src_file'), columns.index('start_id'),
+                columns.index('start_station_name'), columns.index('end_id'), columns.index('end_station_name'),
+                columns.index('usertype'), rideable_type)
+
+    def _file_key(self, src_file):
+        return self._lookup(self._files, src_file, 'bluebikes_files', ['src_file'], [src_file])
+
+    def _station_key(self, station):
+        return self._lookup(self._stations, station, 'bluebikes_stations', ['station_id', 'station_name'], station)
+
+    def _usertype_key(self, usertype):
+        return self._lookup(self._usertypes, usertype, 'bluebikes_usertypes', ['usertype'], [usertype])
+
+    def _rideable_type_key(self, rideable_type):
+        return self._lookup(self._rideable_types, rideable_type, 'bluebikes_rideable_types', ['rideable_type'],
+                            [rideable_type])
+
+    def _lookup(self, cache, value, table, columns, values):
+        # the row may exist from a previous run, and column affinity can make it differ from the raw string
+        self._cursor.execute("INSERT OR IGNORE INTO %s (%s) VALUES (%s)" % (
+            table, ", ".join(columns), ", ".join("?" * len(columns))), values)
+        where = " AND ".join("%s = ?" % column for column in columns)
+        key = self._cursor.execute("SELECT key FROM %s WHERE %s" % (table, where), values).fetchone()[0]
+        cache[value] = key
+        return key
@@ -0,0 +1,36 @@
+import os
+from functools import partial
+
+import bluebikes.download
+import bluebikes.insert
+
+
+def download_and_insert(data_dir, s3_files, bucket=None, database=bluebikes.insert.DATABASE,
+                        num_parsers=os.cpu_count(), layout='wide', threads=bluebikes.download.DOWNLOAD_THREADS,
+                        queue_depth=bluebikes.insert.STREAM_QUEUE_DEPTH, chunk_size=bluebikes.insert.STREAM_CHUNK_SIZE,
+                        profile_dir=None, csv_parser='csv'):
+    """
+    Overlaps the download, parse and insert stages: every archive is handed to the parsers as soon as its
+    download finishes, and the single writer inserts while later archives are still downloading. The wall
+    clock time is then close to that of the slowest stage rather than the sum of them.
+    Returns the TripSources that were loaded and the WorkerStats dicts of the parsers and the writer.
+    """
+    file_metadata = {}
+    loaded_sources = []
+    # the largest archives go first so their parsing overlaps with the rest of the downloads
+    s3_files = sorted(s3_files, key=lambda x: x[1], reverse=True)
+    feed = partial(_download_to_queue, data_dir, s3_files, bucket, threads, chunk_size, file_metadata,
+                   loaded_sources)
+    worker_stats = bluebikes.insert.stream_insert(feed, database, num_parsers, file_metadata, queue_depth, layout,
+                                                  profile_dir=profile_dir, csv_parser=csv_parser)
+    return loaded_sources, worker_stats
+
+
+def _download_to_queue(data_dir, s3_files, bucket, threads, chunk_size, file_metadata, loaded_sources, file_queue):
+    for (s3_key, size, etag), trip_sources, _ in bluebikes.download.iter_downloads(data_dir, s3_files, bucket,
+                                                                                  threads):
+        for source in trip_sources:
+            # the writer looks the metadata up once the file is done, so it must be there before it is queued
+            file_metadata[source.src_file] = (s3_key, size, etag)
+            loaded_sources.append(source)
+        bluebikes.insert.put_chunks(trip_sources, chunk_size, file_queue)
@@ -0,0 +1,27 @@
+import sqlite3
+
+from tqdm import tqdm
+
+import bluebikes.sql
+
+
+def refresh_rollups(database, src_files):
+    """
+    Recomputes the station/hour, station/day and origin-destination rollups of the given source files.
+    Rollup rows are keyed by src_file, so adding a month only aggregates that month's trips.
+    This relies on the src_file index to avoid scanning the whole table for every file.
+    """
+    conn = sqlite3.connect(database, isolation_level=None)
+    conn.executescript(bluebikes.sql.rollups_create)
+    for src_file in tqdm(src_files, desc="Building rollups"):
+        conn.execute('BEGIN IMMEDIATE')
+        delete_rollups(conn, src_file)
+        for rollup_insert in bluebikes.sql.rollup_inserts:
+            conn.execute(rollup_insert, {'src_file': src_file})
+        conn.execute('COMMIT')
+    conn.close()
+
+
+def delete_rollups(conn, src_file):
+    for table in bluebikes.sql.rollup_tables:
+        conn.execute('DELETE FROM %s WHERE src_file = ?' % table, [src_file])
@@ -0,0 +1,34 @@
+import sqlite3
+from statistics import median
+
+import bluebikes.sql
+
+
+def read_load_stats(database):
+    """
+    Returns {src_file: (size, seconds)} of every file a previous run has parsed and inserted
+    """
+    conn = sqlite3.connect(database, isolation_level=None)
+    conn.execute(bluebikes.sql.load_stats_create)
+    rows = conn.execute('SELECT src_file, size, seconds FROM bluebikes_load_stats').fetchall()
+    conn.close()
+    return {src_file: (size, seconds) for src_file, size, seconds in rows}
+
+
+def order_by_cost(sources, load_stats=None):
+    """
+    Sorts TripSources by their estimated cost, most expensive first, so the cheap files fill in at the end.
+    The cost is the time measured by a previous run for a file of the same size. Other files are estimated
+    from their size at the median seconds per byte of the measured files, or ordered by size without stats.
+    """
+    load_stats = load_stats or {}
+    rates = [seconds / size for size, seconds in load_stats.values() if size]
+    seconds_per_byte = median(rates) if rates else 1
+
+    def cost(source):
+        size, seconds = load_stats.get(source.src_file, (None, None))
+        if size == source.size:
+            return seconds
+        return source.size * seconds_per_byte
+
+    return sorted(sources, key=cost, reverse=True)
@@ -0,0 +1,154 @@
+from functools import lru_cache
+from itertools import repeat
+from operator import itemgetter
+
+import bluebikes.distance
+import bluebikes.timestamps
+
+# maps the (lower case) CSV header names of every published layout to columns of the bluebikes table
+HEADER_COLUMNS = {
+    # up to and including 202303
+    'tripduration': 'tripduration',
+    'starttime': 'started_at',
+    'stoptime': 'ended_at',
+    'start station id': 'start_id',
+    'start station name': 'start_station_name',
+    'start station latitude': 'start_lat',
+    'start station longitude': 'start_lng',
+    'end station id': 'end_id',
+    'end station name': 'end_station_name',
+    'end station latitude': 'end_lat',
+    'end station longitude': 'end_lng',
+    'bikeid': 'ride_id',
+    'usertype': 'usertype',
+    'birth year': 'birth_year',
+    'gender': 'gender',
+    'postal code': 'postal_code',
+    # from 202304
+    'ride_id': 'ride_id',
+    'rideable_type': 'rideable_type',
+    'started_at': 'started_at',
+    'ended_at': 'ended_at',
+    'start_station_name': 'start_station_name',
+    'start_station_id': 'start_id',
+    'end_station_name': 'end_station_name',
+    'end_station_id': 'end_id',
+    'start_lat': 'start_lat',
+    'start_lng': 'start_lng',
+    'end_lat': 'end_lat',
+    'end_lng': 'end_lng',
+    'member_casual': 'usertype',
+}
+
+# computed from the coordinates, duration and timestamps of every trip, appended to the columns of each layout
+DERIVED_COLUMNS = ('distance_meters', 'speed_kmh', 'bad_coordinates', 'started_at_epoch', 'ended_at_epoch')
+
+COORDINATE_COLUMNS = ('start_lat', 'start_lng', 'end_lat', 'end_lng')
+
+# tripduration is derived from started_at and ended_at when a layout doesn't include it
+REQUIRED_COLUMNS = [
+    'started_at',
+    'ended_at',
+    'start_id',
+    'start_station_name',
+    'start_lat',
+    'start_lng',
+    'end_id',
+    'end_station_name',
+    'end_lat',
+    'end_lng',
+    'ride_id',
+    'usertype',
+]
+
+
+class RowAdapter:
+    """
+    Turns raw CSV rows of one file into tuples of bluebikes columns, listed in self.columns, with
+    src_file (and the trip duration when the file has none) prepended and the DERIVED_COLUMNS appended.
+    Build it with adapter_for_header().
+    """
+
+    def __init__(self, src_file, columns, indexes, timestamp_indexes, coordinate_indexes, tripduration_index):
+        self.src_file = src_file
+        self.columns = columns
+        # the CSV columns the values are taken from, which include those of started_at and ended_at
+        self.indexes = indexes
+        self._constants = (src_file,)
+        self._project = itemgetter(*indexes)
+        self._timestamp_indexes = timestamp_indexes
+        self._coordinate_indexes = coordinate_indexes
+        # None when the duration is derived from the timestamps
+        self._tripduration_index = tripduration_index
+        self._derived_from = set(timestamp_indexes) | set(coordinate_indexes)
+        if tripduration_index is not None:
+            self._derived_from.add(tripduration_index)
+
+    def adapt(self, rows):
+        columns = {i: list(map(itemgetter(i), rows)) for i in self._derived_from}
+        durations, derived = self._derive(columns)
+        constants = self._constants
+        project = self._project
+        if durations is None:
+            return [constants + project(row) + tail for row, tail in zip(rows, zip(*derived))]
+        return [constants + (duration,) + project(row) + tail
+                for row, duration, tail in zip(rows, durations, zip(*derived))]
+
+    def adapt_columns(self, columns, num_rows):
+        """
+        Like adapt(), but for a batch of num_rows given as a list of values per CSV column, looked up by
+        column index. Only the columns in self.indexes are used.
+        """
+        durations, derived = self._derive(columns)
+        projected = [columns[i] for i in self.indexes]
+        src_files = repeat(self.src_file, num_rows)
+        if durations is None:
+            return list(zip(src_files, *projected, *derived))
+        return list(zip(src_files, durations, *projected, *derived))
+
+    def _derive(self, columns):
+        # returns the derived durations, or None when the file has them, and the lists of the DERIVED_COLUMNS
+        started_at, ended_at = (bluebikes.timestamps.to_datetime64(columns[i]) for i in self._timestamp_indexes)
+        epochs = (bluebikes.timestamps.to_epochs(started_at), bluebikes.timestamps.to_epochs(ended_at))
+        coordinates = [columns[i] for i in self._coordinate_indexes]
+        if self._tripduration_index is not None:
+            return None, bluebikes.distance.trip_metrics(*coordinates, columns[self._tripduration_index]) + epochs
+        durations = bluebikes.timestamps.seconds_between(started_at, ended_at)
+        return durations, bluebikes.distance.trip_metrics(*coordinates, durations) + epochs
+
+
+def adapter_for_header(header, src_file):
+    """
+    Compiles a RowAdapter for a CSV file from its header row.
+    Raises ValueError when the header is missing any of the REQUIRED_COLUMNS.
+    """
+    return RowAdapter(src_file, *_compile_layout(tuple(header)))
+
+
+@lru_cache(maxsize=None)
+def _compile_layout(header):
+    columns = []
+    indexes = []
+    for index, name in enumerate(header):
+        # some files start with a byte order mark
+        column = HEADER_COLUMNS.get(name.lstrip('\ufeff').strip().lower())
+        if column is not None and column not in columns:
+            columns.append(column)
+            indexes.append(index)
+
+    missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+    if missing:
+        raise ValueError("Unrecognized CSV layout, missing columns %s in header %s" % (missing, list(header)))
+
+    tripduration_index = None
+    insert_columns = ['src_file']
+    if 'tripduration' in columns:
+        tripduration_index = indexes[columns.index('tripduration')]
+    else:
+        insert_columns.append('tripduration')
+    insert_columns.extend(columns)
+    insert_columns.extend(DERIVED_COLUMNS)
+    timestamp_indexes = (indexes[columns.index('started_at')], indexes[columns.index('ended_at')])
+    coordinate_indexes = tuple(indexes[columns.index(column)] for column in COORDINATE_COLUMNS)
+
+    return tuple(insert_columns), indexes, timestamp_indexes, coordinate_indexes, tripduration_index
@@ -0,0 +1,168 @@
+import csv
+import glob
+import io
+import os
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+
+# bytes read at a time while looking for chunk boundaries
+SCAN_BLOCK_SIZE = 1024 * 1024
+
+# A trip CSV, either a plain file or a member of a downloaded zip archive that is read without extracting it.
+# src_file is the path the CSV has (or would have once extracted) in the data directory, which is the value
+# stored in the src_file column. size is the uncompressed size in bytes.
+# A chunk of a CSV, see split_source(), also has the [start, end) byte range it covers, the header of the
+# file and the number of chunks the file was split into. size is then the length of the range.
+TripSource = namedtuple('TripSource', ['src_file', 'archive', 'member', 'size', 'start', 'end', 'header',
+                                       'chunk_count'], defaults=[None, None, None, 1])
+
+
+def find_sources(data_dir):
+    """
+    Returns a TripSource for every trip CSV inside the zip archives of data_dir, and for any plain trip CSV
+    that isn't also in an archive
+    """
+    sources = {}
+    for csv_file in glob.glob(os.path.join(data_dir, '*tripdata.csv')):
+        sources[csv_file] = as_source(csv_file)
+    for archive in sorted(glob.glob(os.path.join(data_dir, '*.zip'))):
+        for source in archive_sources(archive, data_dir):
+            sources[source.src_file] = source
+    return list(sources.values())
+
+
+def archive_sources(archive, data_dir):
+    with zipfile.ZipFile(archive) as zip_ref:
+        return [TripSource(os.path.join(data_dir, info.filename), archive, info.filename, info.file_size)
+                for info in zip_ref.infolist() if is_trip_csv(info.filename)]
+
+
+def is_trip_csv(member_name):
+    # some of the BB files were zipped with hidden __MACOSX directories
+    return not member_name.startswith('__MACOSX') and member_name.endswith('tripdata.csv')
+
+
+def as_source(file):
+    """
+    Accepts a TripSource or the path of a plain CSV file
+    """
+    if isinstance(file, TripSource):
+        return file
+    return TripSource(file, None, None, os.path.getsize(file))
+
+
+def split_source(source, chunk_size):
+    """
+    Splits a trip CSV larger than chunk_size into chunks of about chunk_size bytes that can be parsed
+    independently. Every chunk ends on a newline outside of quoted fields. The first chunk starts with the
+    header line, the others carry the parsed header. Smaller files are returned whole.
+    """
+    if source.size <= chunk_size or source.start is not None:
+        return [source]
+    with _open_binary(source) as f:
+        header_line = f.readline()
+        boundaries = _chunk_boundaries(f, len(header_line), source.size, chunk_size)
+    header = tuple(next(csv.reader(io.TextIOWrapper(io.BytesIO(header_line), newline=''))))
+    boundaries[0] = 0
+    chunk_count = len(boundaries) - 1
+    return [source._replace(size=end - start, start=start, end=end, header=header if start else None,
+                            chunk_count=chunk_count)
+            for start, end in zip(boundaries, boundaries[1:])]
+
+
+def _chunk_boundaries(f, start, size, chunk_size):
+    """
+    Returns the offsets from start to size at which chunks begin and end. The stream is read from start on,
+    keeping track of the parity of the quotes seen: a newline is a row boundary when it is even, because
+    quotes within quoted fields are escaped by doubling them.
+    """
+    boundaries = [start]
+    target = start + chunk_size
+    position = start
+    in_quotes = 0
+    while target < size:
+        block = f.read(SCAN_BLOCK_SIZE)
+        if not block:
+            break
+        cursor = 0
+        while target < position + len(block):
+            offset = max(cursor, target - position)
+            in_quotes ^= block.count(b'"', cursor, offset) & 1
+            cursor = offset
+            newline = block.find(b'\n', cursor)
+            while newline != -1:
+                in_quotes ^= block.count(b'"', cursor, newline) & 1
+                cursor = newline + 1
+                if not in_quotes:
+                    break
+                newline = block.find(b'\n', cursor)
+            if newline == -1:
+                # the boundary is in a later block
+                break
+            boundaries.append(position + cursor)
+            target = position + cursor + chunk_size
+        in_quotes ^= block.count(b'"', cursor) & 1
+        position += len(block)
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return boundaries
+
+
+@contextmanager
+def open_source(source):
+    """
+    Opens the CSV, or the byte range of a chunk, as a text stream, decompressing archive members on the fly
+    """
+    if source.start is not None:
+        with open_source_bytes(source) as f:
+            yield io.TextIOWrapper(f, newline='')
+    elif source.archive is None:
+        with open(source.src_file, newline='') as csvfile:
+            yield csvfile
+    else:
+        with zipfile.ZipFile(source.archive) as zip_ref, zip_ref.open(source.member) as member:
+            yield io.TextIOWrapper(member, newline='')
+
+
+@contextmanager
+def open_source_bytes(source):
+    """
+    Like open_source(), but yields a binary stream
+    """
+    with _open_binary(source) as f:
+        if source.start is None:
+            yield f
+        else:
+            # archive members can seek, but have to decompress everything before the start to do so
+            f.seek(source.start)
+            yield io.BufferedReader(_RangeReader(f, source.end - source.start))
+
+
+@contextmanager
+def _open_binary(source):
+    if source.archive is None:
+        with open(source.src_file, 'rb') as f:
+            yield f
+    else:
+        with zipfile.ZipFile(source.archive) as zip_ref, zip_ref.open(source.member) as member:
+            yield member
+
+
+class _RangeReader(io.RawIOBase):
+    """
+    Reads at most length bytes from the current position of a binary stream
+    """
+
+    def __init__(self, f, length):
+        self._f = f
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._f.read(min(len(buffer), self._remaining))
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
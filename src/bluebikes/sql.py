@@ -1,114 +1,370 @@
-table_drop = "DROP TABLE IF EXISTS bluebikes; "
-
-table_create = """
-CREATE TABLE bluebikes (
-    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-    src_file TEXT NOT NULL,
-    tripduration INTEGER NOT NULL,
-    started_at TEXT NOT NULL,
-    ended_at TEXT NOT NULL,
-    start_id INTEGER NOT NULL,
-    start_station_name TEXT NOT NULL,
-    start_lat REAL NOT NULL,
-    start_lng REAL NOT NULL,
-    end_id INTEGER NOT NULL,
-    end_station_name TEXT NOT NULL,
-    end_lat REAL NOT NULL,
-    end_lng REAL NOT NULL,
-    ride_id INTEGER NOT NULL,
-    usertype TEXT NOT NULL,
-    birth_year INTEGER,
-    gender TEXT,    
-    rideable_type TEXT,
-    postal_code TEXT
-);
-"""
-
-# all records up to and including 202004-bluebikes-tripdata.csv
-insert_stmt_v0 = """
-INSERT INTO bluebikes (  
-    src_file,          
-    tripduration,
-    started_at, 
-    ended_at,
-    start_id,
-    start_station_name,
-    start_lat,
-    start_lng,
-    end_id,
-    end_station_name,
-    end_lat,
-    end_lng,
-    ride_id,
-    usertype,
-    birth_year,
-    gender
-)
-VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-"""
-
-# all records between 202005-bluebikes-tripdata.csv - 202303-bluebikes-tripdata.csv
-insert_stmt_v1 = """
-INSERT INTO bluebikes (  
-    src_file,          
-    tripduration,
-    started_at, 
-    ended_at,
-    start_id,
-    start_station_name,
-    start_lat,
-    start_lng,
-    end_id,
-    end_station_name,
-    end_lat,
-    end_lng,
-    ride_id,
-    usertype,
-    postal_code
-)
-VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-"""
-
-# all records between 202304-bluebikes-tripdata.csv - 202403-bluebikes-tripdata.csv
-insert_stmt_v2 = """
-INSERT INTO bluebikes (  
-    src_file,
-    ride_id,     
-    rideable_type,     
-    tripduration,
-    started_at, 
-    ended_at,
-    start_station_name,
-    start_id,    
-    end_station_name,
-    end_id,    
-    start_lat,
-    start_lng,    
-    end_lat,
-    end_lng,    
-    usertype    
-)
-VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-"""
-
-# id insert
-id_insert = """
-INSERT INTO bluebikes (  
-    id,
-    src_file,          
-    tripduration,
-    started_at, 
-    ended_at,
-    start_id,
-    start_station_name,
-    start_lat,
-    start_lng,
-    end_id,
-    end_station_name,
-    end_lat,
-    end_lng,
-    ride_id,
-    usertype
-)
-VALUES (?, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1);
+table_drop = "DROP TABLE IF EXISTS bluebikes; "
+
+manifest_drop = "DROP TABLE IF EXISTS bluebikes_manifest; "
+
+# one row per loaded CSV, used to only import new or changed monthly files
+manifest_create = """
+CREATE TABLE IF NOT EXISTS bluebikes_manifest (
+    src_file TEXT PRIMARY KEY NOT NULL,
+    s3_key TEXT,
+    s3_size INTEGER,
+    s3_etag TEXT,
+    row_count INTEGER NOT NULL,
+    loaded_at TEXT NOT NULL
+);
+"""
+
+manifest_upsert = """
+INSERT OR REPLACE INTO bluebikes_manifest (
+    src_file,
+    s3_key,
+    s3_size,
+    s3_etag,
+    row_count,
+    loaded_at
+)
+VALUES (?, ?, ?, ?, ?, datetime('now'));
+"""
+
+# how long each CSV took to parse and insert, kept across rebuilds so files can be scheduled by measured cost
+load_stats_create = """
+CREATE TABLE IF NOT EXISTS bluebikes_load_stats (
+    src_file TEXT PRIMARY KEY NOT NULL,
+    size INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    loaded_at TEXT NOT NULL
+);
+"""
+
+load_stats_upsert = """
+INSERT OR REPLACE INTO bluebikes_load_stats (
+    src_file,
+    size,
+    row_count,
+    seconds,
+    loaded_at
+)
+VALUES (?, ?, ?, ?, datetime('now'));
+"""
+
+rejected_rows_drop = "DROP TABLE IF EXISTS bluebikes_rejected_rows; "
+
+# rows that failed to insert, so a bad line can be found without re-running the import. The line counts
+# from the byte offset start, which is 0 unless the file was split into chunks.
+rejected_rows_create = """
+CREATE TABLE IF NOT EXISTS bluebikes_rejected_rows (
+    src_file TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    line INTEGER NOT NULL,
+    error TEXT NOT NULL,
+    row TEXT NOT NULL
+);
+"""
+
+rejected_rows_insert = """
+INSERT INTO bluebikes_rejected_rows (
+    src_file,
+    start,
+    line,
+    error,
+    row
+)
+VALUES (?, ?, ?, ?, ?);
+"""
+
+# columns computed at ingest, after those of the CSVs. insert.create_tables adds them to databases created
+# before they existed. distance_meters is the great circle distance between the start and end coordinates and
+# bad_coordinates is 1 when either of them is missing, out of range or 0,0. The epochs count the published
+# local time as if it were UTC, and the calendar columns are generated from started_at_epoch when read, so
+# they take no space but can be indexed.
+derived_columns = [
+    ('distance_meters', 'REAL'),
+    ('speed_kmh', 'REAL'),
+    ('bad_coordinates', 'INTEGER'),
+    ('started_at_epoch', 'INTEGER'),
+    ('ended_at_epoch', 'INTEGER'),
+    ('start_year', "INTEGER GENERATED ALWAYS AS (CAST(strftime('%Y', started_at_epoch, 'unixepoch') AS INTEGER))"),
+    ('start_month', "INTEGER GENERATED ALWAYS AS (CAST(strftime('%m', started_at_epoch, 'unixepoch') AS INTEGER))"),
+    # 0 is Sunday like strftime('%w'), 1970-01-01 was a Thursday
+    ('start_dow', "INTEGER GENERATED ALWAYS AS ((started_at_epoch / 86400 + 4) % 7)"),
+    ('start_hour', "INTEGER GENERATED ALWAYS AS (started_at_epoch % 86400 / 3600)"),
+]
+
+_derived_columns_sql = ",\n".join("    %s %s" % column for column in derived_columns)
+
+table_create = """
+CREATE TABLE IF NOT EXISTS bluebikes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    src_file TEXT NOT NULL,
+    tripduration INTEGER NOT NULL,
+    started_at TEXT NOT NULL,
+    ended_at TEXT NOT NULL,
+    start_id INTEGER NOT NULL,
+    start_station_name TEXT NOT NULL,
+    start_lat REAL NOT NULL,
+    start_lng REAL NOT NULL,
+    end_id INTEGER NOT NULL,
+    end_station_name TEXT NOT NULL,
+    end_lat REAL NOT NULL,
+    end_lng REAL NOT NULL,
+    ride_id INTEGER NOT NULL,
+    usertype TEXT NOT NULL,
+    birth_year INTEGER,
+    gender TEXT,    
+    rideable_type TEXT,
+    postal_code TEXT,
+%s
+);
+""" % _derived_columns_sql
+
+
+def insert_stmt(columns):
+    """
+    Builds the insert statement for rows holding the given bluebikes columns, in order
+    """
+    return "INSERT INTO bluebikes (%s) VALUES (%s);" % (", ".join(columns), ", ".join("?" * len(columns)))
+
+
+# optional compact layout, repeated strings are stored once in dimension tables and the fact table holds
+# their integer keys. The bluebikes view presents the same columns as the wide bluebikes table.
+normalized_drop = """
+DROP VIEW IF EXISTS bluebikes;
+DROP TABLE IF EXISTS bluebikes_trips;
+DROP TABLE IF EXISTS bluebikes_files;
+DROP TABLE IF EXISTS bluebikes_stations;
+DROP TABLE IF EXISTS bluebikes_usertypes;
+DROP TABLE IF EXISTS bluebikes_rideable_types;
+"""
+
+normalized_create = """
+CREATE TABLE IF NOT EXISTS bluebikes_files (
+    key INTEGER PRIMARY KEY NOT NULL,
+    src_file TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS bluebikes_stations (
+    key INTEGER PRIMARY KEY NOT NULL,
+    station_id INTEGER NOT NULL,
+    station_name TEXT NOT NULL,
+    UNIQUE (station_id, station_name)
+);
+
+CREATE TABLE IF NOT EXISTS bluebikes_usertypes (
+    key INTEGER PRIMARY KEY NOT NULL,
+    usertype TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS bluebikes_rideable_types (
+    key INTEGER PRIMARY KEY NOT NULL,
+    rideable_type TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS bluebikes_trips (
+    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    file_key INTEGER NOT NULL,
+    tripduration INTEGER NOT NULL,
+    started_at TEXT NOT NULL,
+    ended_at TEXT NOT NULL,
+    start_station_key INTEGER NOT NULL,
+    start_lat REAL NOT NULL,
+    start_lng REAL NOT NULL,
+    end_station_key INTEGER NOT NULL,
+    end_lat REAL NOT NULL,
+    end_lng REAL NOT NULL,
+    ride_id INTEGER NOT NULL,
+    usertype_key INTEGER NOT NULL,
+    birth_year INTEGER,
+    gender TEXT,
+    rideable_type_key INTEGER,
+    postal_code TEXT,
+%s
+);
+
+CREATE VIEW IF NOT EXISTS bluebikes AS
+SELECT t.id,
+       f.src_file,
+       t.tripduration,
+       t.started_at,
+       t.ended_at,
+       ss.station_id   AS start_id,
+       ss.station_name AS start_station_name,
+       t.start_lat,
+       t.start_lng,
+       es.station_id   AS end_id,
+       es.station_name AS end_station_name,
+       t.end_lat,
+       t.end_lng,
+       t.ride_id,
+       u.usertype,
+       t.birth_year,
+       t.gender,
+       r.rideable_type,
+       t.postal_code,
+%s
+FROM bluebikes_trips t
+         JOIN bluebikes_files f ON f.key = t.file_key
+         JOIN bluebikes_stations ss ON ss.key = t.start_station_key
+         JOIN bluebikes_stations es ON es.key = t.end_station_key
+         JOIN bluebikes_usertypes u ON u.key = t.usertype_key
+         LEFT JOIN bluebikes_rideable_types r ON r.key = t.rideable_type_key;
+""" % (_derived_columns_sql, ",\n".join("       t.%s" % name for name, _ in derived_columns))
+
+normalized_delete_src_file = """
+DELETE FROM bluebikes_trips WHERE file_key IN (SELECT key FROM bluebikes_files WHERE src_file = ?);
+"""
+
+
+def normalized_insert_stmt(columns):
+    """
+    Builds the insert statement for rows holding the given bluebikes_trips columns, in order
+    """
+    return "INSERT INTO bluebikes_trips (%s) VALUES (%s);" % (", ".join(columns), ", ".join("?" * len(columns)))
+
+
+# precomputed trip counts, keyed by src_file so reloading a month only recomputes its own rows
+rollups_drop = """
+DROP TABLE IF EXISTS bluebikes_station_hourly;
+DROP TABLE IF EXISTS bluebikes_station_daily;
+DROP TABLE IF EXISTS bluebikes_od_monthly;
+"""
+
+rollups_create = """
+CREATE TABLE IF NOT EXISTS bluebikes_station_hourly (
+    src_file TEXT NOT NULL,
+    station_id INTEGER NOT NULL,
+    hour TEXT NOT NULL,
+    departures INTEGER NOT NULL,
+    arrivals INTEGER NOT NULL,
+    PRIMARY KEY (station_id, hour, src_file)
+);
+CREATE INDEX IF NOT EXISTS bluebikes_station_hourly_src_file ON bluebikes_station_hourly (src_file);
+
+CREATE TABLE IF NOT EXISTS bluebikes_station_daily (
+    src_file TEXT NOT NULL,
+    station_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    departures INTEGER NOT NULL,
+    arrivals INTEGER NOT NULL,
+    PRIMARY KEY (station_id, day, src_file)
+);
+CREATE INDEX IF NOT EXISTS bluebikes_station_daily_src_file ON bluebikes_station_daily (src_file);
+
+CREATE TABLE IF NOT EXISTS bluebikes_od_monthly (
+    src_file TEXT NOT NULL,
+    month TEXT NOT NULL,
+    start_id INTEGER NOT NULL,
+    end_id INTEGER NOT NULL,
+    trips INTEGER NOT NULL,
+    avg_tripduration REAL,
+    PRIMARY KEY (start_id, end_id, month, src_file)
+);
+CREATE INDEX IF NOT EXISTS bluebikes_od_monthly_src_file ON bluebikes_od_monthly (src_file);
+"""
+
+rollup_tables = ['bluebikes_station_hourly', 'bluebikes_station_daily', 'bluebikes_od_monthly']
+
+# each statement recomputes the rows of the :src_file parameter
+rollup_inserts = [
+    """
+    INSERT INTO bluebikes_station_hourly (src_file, station_id, hour, departures, arrivals)
+    SELECT src_file, station_id, hour, SUM(departures), SUM(arrivals)
+    FROM (SELECT src_file, start_id AS station_id, substr(started_at, 1, 13) AS hour, 1 AS departures, 0 AS arrivals
+          FROM bluebikes
+          WHERE src_file = :src_file
+          UNION ALL
+          SELECT src_file, end_id, substr(ended_at, 1, 13), 0, 1
+          FROM bluebikes
+          WHERE src_file = :src_file)
+    GROUP BY 1, 2, 3;
+    """,
+    """
+    INSERT INTO bluebikes_station_daily (src_file, station_id, day, departures, arrivals)
+    SELECT src_file, station_id, day, SUM(departures), SUM(arrivals)
+    FROM (SELECT src_file, start_id AS station_id, substr(started_at, 1, 10) AS day, 1 AS departures, 0 AS arrivals
+          FROM bluebikes
+          WHERE src_file = :src_file
+          UNION ALL
+          SELECT src_file, end_id, substr(ended_at, 1, 10), 0, 1
+          FROM bluebikes
+          WHERE src_file = :src_file)
+    GROUP BY 1, 2, 3;
+    """,
+    """
+    INSERT INTO bluebikes_od_monthly (src_file, month, start_id, end_id, trips, avg_tripduration)
+    SELECT src_file, substr(started_at, 1, 7), start_id, end_id, COUNT(*), AVG(tripduration)
+    FROM bluebikes
+    WHERE src_file = :src_file
+    GROUP BY 1, 2, 3, 4;
+    """,
+]
+
+# indexes built by bluebikes.finalize once all rows are loaded, keyed by the name used on the command line.
+# The extra columns cover the usual time range and per station queries without touching the table
+indexes = {
+    'started_at': """
+        CREATE INDEX IF NOT EXISTS bluebikes_started_at ON bluebikes (started_at, start_id, end_id, tripduration);
+    """,
+    'start_id': """
+        CREATE INDEX IF NOT EXISTS bluebikes_start_id ON bluebikes (start_id, started_at, end_id);
+    """,
+    'end_id': """
+        CREATE INDEX IF NOT EXISTS bluebikes_end_id ON bluebikes (end_id, started_at, start_id);
+    """,
+    'src_file': """
+        CREATE INDEX IF NOT EXISTS bluebikes_src_file ON bluebikes (src_file);
+    """,
+    'started_at_epoch': """
+        CREATE INDEX IF NOT EXISTS bluebikes_started_at_epoch ON bluebikes (started_at_epoch, start_id, end_id);
+    """,
+    # for trips per year, month, weekday or hour of the day
+    'calendar': """
+        CREATE INDEX IF NOT EXISTS bluebikes_calendar ON bluebikes (start_year, start_month, start_dow, start_hour);
+    """,
+}
+
+normalized_indexes = {
+    'started_at': """
+        CREATE INDEX IF NOT EXISTS bluebikes_trips_started_at
+            ON bluebikes_trips (started_at, start_station_key, end_station_key, tripduration);
+    """,
+    'start_id': """
+        CREATE INDEX IF NOT EXISTS bluebikes_trips_start_station ON bluebikes_trips (start_station_key, started_at);
+    """,
+    'end_id': """
+        CREATE INDEX IF NOT EXISTS bluebikes_trips_end_station ON bluebikes_trips (end_station_key, started_at);
+    """,
+    'src_file': """
+        CREATE INDEX IF NOT EXISTS bluebikes_trips_file ON bluebikes_trips (file_key);
+    """,
+    'started_at_epoch': """
+        CREATE INDEX IF NOT EXISTS bluebikes_trips_started_at_epoch
+            ON bluebikes_trips (started_at_epoch, start_station_key, end_station_key);
+    """,
+    'calendar': """
+        CREATE INDEX IF NOT EXISTS bluebikes_trips_calendar
+            ON bluebikes_trips (start_year, start_month, start_dow, start_hour);
+    """,
+}
+
+# id insert
+id_insert = """
+INSERT INTO bluebikes (  
+    id,
+    src_file,          
+    tripduration,
+    started_at, 
+    ended_at,
+    start_id,
+    start_station_name,
+    start_lat,
+    start_lng,
+    end_id,
+    end_station_name,
+    end_lat,
+    end_lng,
+    ride_id,
+    usertype
+)
+VALUES (?, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1);
 """
\ No newline at end of file
@@ -1,11 +1,15 @@
 import json
+import math
 import os
 import pprint
+from collections import defaultdict
 
+import numpy as np
 import pandas as pd
 import argparse
 from tqdm import tqdm
-from haversine import haversine, Unit
+
+from bluebikes import distance
 
 # 25 meters seems to be the sweet spot to minimize false positives and negatives
 DEFAULT_MAX_DISTANCE_METERS = 25
@@ -97,7 +101,7 @@ def load_input_csv(filename):
 
 # calculate the distance between two coordinates in km
 def calculate_distance(lat1, lng1, lat2, lng2):
-    return haversine((lat1, lng1), (lat2, lng2), unit=Unit.METERS)
+    return float(distance.haversine_meters(lat1, lng1, lat2, lng2))
 
 
 # There are ~1k records with a GPS coordinate pointing to the wrong place with the wrong ID and name.
@@ -113,6 +117,47 @@ def is_bad_hospital(start_lat, start_lng, start_station_name):
     return True
 
 
+class StationGrid:
+    """
+    Buckets stations into cubes on the unit sphere that are max_distance wide, so every station within
+    max_distance of a point is in one of the 27 cubes around it and only those are compared.
+    """
+
+    def __init__(self, station_ids, lats, lngs, max_distance):
+        self.max_distance = max_distance
+        # a straight line through the sphere is never longer than the arc, a little slack covers rounding
+        self.cell_size = max(max_distance, 1) / distance.EARTH_RADIUS_METERS * 1.001
+        self.station_ids = np.asarray(station_ids, dtype=object)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.cells = defaultdict(list)
+        # stations without coordinates are never the closest, their distance is NaN
+        located = np.flatnonzero(~np.isnan(self.lats) & ~np.isnan(self.lngs))
+        for index, cell in zip(located.tolist(), self._cells(self.lats[located], self.lngs[located]).tolist()):
+            self.cells[tuple(cell)].append(index)
+
+    def _cells(self, lats, lngs):
+        lats, lngs = np.radians(lats), np.radians(lngs)
+        points = np.stack([np.cos(lats) * np.cos(lngs), np.cos(lats) * np.sin(lngs), np.sin(lats)], axis=-1)
+        return np.floor(points / self.cell_size).astype(np.int64)
+
+    def closest(self, lat, lng):
+        """
+        Returns (station_id, meters) of the closest station if it is within max_distance, the one added first
+        on ties, else (None, inf)
+        """
+        if math.isnan(lat) or math.isnan(lng):
+            return None, float('inf')
+        x, y, z = self._cells(lat, lng).tolist()
+        candidates = np.array(sorted(index for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                                     for index in self.cells.get((x + dx, y + dy, z + dz), ())), dtype=np.int64)
+        indexes, meters = distance.nearest_within(lat, lng, self.lats[candidates], self.lngs[candidates],
+                                                  self.max_distance)
+        if len(indexes) == 0:
+            return None, float('inf')
+        return self.station_ids[candidates[indexes[0]]], float(meters[0])
+
+
 # print out stations with duplicate mappings (123|45 -> ABC001)
 def log_duplicates(station_id_mapping):
     duplicates = {}
@@ -174,11 +219,8 @@ def format_results(station_id_mapping, missing_station_id_mapping):
     return results
 
 
-def generate_mapping(filename, max_distance=DEFAULT_MAX_DISTANCE_METERS,
-                     verbose=False, write_to_disk=None):
-    df = load_input_csv(filename)
-    print("Matching stations under %d meters" % max_distance)
-
+# match every legacy row of the station facets to current ids by name, else by distance
+def match_stations(df, max_distance=DEFAULT_MAX_DISTANCE_METERS):
     station_id_mapping = {}
     missing_mappings = {}
 
@@ -187,16 +229,18 @@ def generate_mapping(filename, max_distance=DEFAULT_MAX_DISTANCE_METERS,
     df['station_id_int'] = pd.to_numeric(df['station_id'], errors='coerce')
     df_filtered = df[df['station_id_int'].notnull() & (df['station_id_int'] < 1000)]
 
-    # Iterate through the filtered dataframe and create the ID mapping
-    for index, row in tqdm(df_filtered.iterrows(), total=df_filtered.shape[0],
-                           desc="Processing Rows"):
-        station_id = row['station_id']
-        lat = row['lat']
-        lng = row['lng']
-        station_name = row['station_name']
-        closest_id = None
-        closest_distance = float('inf')
+    # Only current ids are candidates, every legacy row is matched against them
+    legacy_ids = set(df_filtered['station_id'])
+    df_current = df[~df['station_id'].isin(legacy_ids)]
+    # the first current station of each name, in file order
+    current_ids_by_name = {}
+    for other_id, other_station_name in zip(df_current['station_id'], df_current['station_name']):
+        current_ids_by_name.setdefault(other_station_name.lower(), other_id)
+    grid = StationGrid(df_current['station_id'], df_current['lat'], df_current['lng'], max_distance)
 
+    # Iterate through the filtered dataframe and create the ID mapping
+    legacy_rows = zip(df_filtered['station_id'], df_filtered['station_name'], df_filtered['lat'], df_filtered['lng'])
+    for station_id, station_name, lat, lng in tqdm(legacy_rows, total=df_filtered.shape[0], desc="Processing Rows"):
         if station_id not in station_id_mapping:
             station_id_mapping[station_id] = set()
 
@@ -207,35 +251,14 @@ def generate_mapping(filename, max_distance=DEFAULT_MAX_DISTANCE_METERS,
             station_id_mapping[station_id].add('BCU-BAD-HOSPITAL')
             continue
 
-        for other_index, other_row in df.iterrows():
-            if other_row['station_id'] in df_filtered['station_id'].values:
-                # Ignore rows that are legacy ids
-                continue
-            if index == other_index:
-                # skip self record
-                continue
-
-            other_id = other_row['station_id']
-            other_lat = other_row['lat']
-            other_lng = other_row['lng']
-            other_station_name = other_row['station_name']
-
-            # Short circuit if station names match directly
-            if station_name.lower() == other_station_name.lower():
-                station_id_mapping[station_id].add(other_id)
-                closest_distance = float('inf')
-                break
-
-            # Calculate distance using haversine
-            distance = calculate_distance(lat, lng, other_lat,
-                                          other_lng)
-            if distance < closest_distance:
-                closest_id = other_id
-                closest_distance = distance
-
-        # Add the closest match to the id_mapping if it is within max distance
-        if closest_distance <= max_distance:
-            station_id_mapping[station_id].add(closest_id)
+        # Short circuit if station names match directly
+        if station_name.lower() in current_ids_by_name:
+            station_id_mapping[station_id].add(current_ids_by_name[station_name.lower()])
+        else:
+            # Add the closest match to the id_mapping if it is within max distance
+            closest_id, closest_distance = grid.closest(lat, lng)
+            if closest_distance <= max_distance:
+                station_id_mapping[station_id].add(closest_id)
 
         if len(station_id_mapping[station_id]) == 0:
             if station_id in missing_mappings:
@@ -243,6 +266,15 @@ def generate_mapping(filename, max_distance=DEFAULT_MAX_DISTANCE_METERS,
             else:
                 missing_mappings[station_id] = {station_name}
 
+    return station_id_mapping, missing_mappings
+
+
+def generate_mapping(filename, max_distance=DEFAULT_MAX_DISTANCE_METERS,
+                     verbose=False, write_to_disk=None):
+    df = load_input_csv(filename)
+    print("Matching stations under %d meters" % max_distance)
+    station_id_mapping, missing_mappings = match_stations(df, max_distance)
+
     if verbose:
         log_duplicates(station_id_mapping)
         log_multiples(station_id_mapping)
@@ -1,10 +1,12 @@
 import argparse
 import pandas as pd
 
+from bluebikes import distance
+
 DEFAULT_OUTPUT_FILE = "data/processed/conflicting_stations.csv"
 
 
-def process(file_path, write_to_disk=None):
+def process(file_path, write_to_disk=None, with_distances=False):
     df = pd.read_csv(file_path)
 
     # Filter out station_ids that are integers under 1000
@@ -29,6 +31,14 @@ def process(file_path, write_to_disk=None):
     highlighted.drop('station_id_int', inplace=True, axis=1)
     highlighted.sort_values(by=['station_name', 'station_id'], inplace=True)
 
+    if with_distances:
+        # How far each row is from the furthest row of the same name, to tell moved stations from mislabeled ones
+        max_distances = pd.Series(index=highlighted.index, dtype=float)
+        for _, group in highlighted.groupby('station_name'):
+            matrix = distance.distance_matrix(group['lat'], group['lng'], group['lat'], group['lng'])
+            max_distances.loc[group.index] = matrix.max(axis=1)
+        highlighted = highlighted.assign(max_distance_meters=max_distances)
+
     if write_to_disk is not None:
         output_file = write_to_disk
         print(f"Writing conflicting stations to {output_file}")
@@ -49,9 +59,11 @@ def main_cli():
     """)
     parser.add_argument("-w", "--write-to-disk", default=DEFAULT_OUTPUT_FILE,
                         help="Writes the results to disk")
+    parser.add_argument("--with_distances", action="store_true",
+                        help="Adds the distance in meters of each row to the furthest row with the same name")
     args = parser.parse_args()
 
-    process(args.station_data, args.write_to_disk)
+    process(args.station_data, args.write_to_disk, args.with_distances)
 
 
 if __name__ == '__main__':
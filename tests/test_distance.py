@@ -0,0 +1,54 @@
+import random
+
+import numpy as np
+import pytest
+from haversine import haversine, Unit
+
+from bluebikes import distance
+
+
+def _random_points(rng, count):
+    return [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(count)]
+
+
+def test_haversine_meters_matches_haversine_package():
+    rng = random.Random(0)
+    points = _random_points(rng, 500)
+    # nearby pairs as well, like stations a few meters apart
+    others = [(lat * 0.9999, lng * 0.9999) for lat, lng in points[:250]] + _random_points(rng, 250)
+
+    for (lat1, lng1), (lat2, lng2) in zip(points, others):
+        expected = haversine((lat1, lng1), (lat2, lng2), unit=Unit.METERS)
+        assert distance.haversine_meters(lat1, lng1, lat2, lng2) == pytest.approx(expected, rel=1e-12, abs=1e-6)
+
+    lats, lngs = np.array(others).T
+    one_to_many = distance.haversine_meters(*points[0], lats, lngs)
+    assert one_to_many == pytest.approx([haversine(points[0], other, unit=Unit.METERS) for other in others],
+                                        rel=1e-12, abs=1e-6)
+
+    matrix = distance.distance_matrix(*np.array(points[:20]).T, lats, lngs)
+    assert matrix.shape == (20, 500)
+    assert matrix[7] == pytest.approx(distance.haversine_meters(*points[7], lats, lngs), rel=1e-12)
+    assert np.isnan(distance.haversine_meters(float('nan'), 0, 0, 0))
+
+
+def test_nearest_within():
+    lats = [42.0, 42.001, float('nan'), 42.0005, 42.001, 43.0]
+    lngs = [-71.0] * len(lats)
+
+    indexes, meters = distance.nearest_within(42.001, -71.0, lats, lngs, 100, k=3)
+    # the tie keeps the order of the points, the point more than 100m away is left out
+    assert indexes.tolist() == [1, 4, 3]
+    assert meters.tolist() == pytest.approx([0, 0, 55.6], abs=0.1)
+    assert distance.nearest_within(42.001, -71.0, lats, lngs, 100)[0].tolist() == [1]
+    assert distance.nearest_within(45.0, -71.0, lats, lngs, 100)[0].tolist() == []
+
+
+def test_trip_metrics():
+    meters, speeds, bad = distance.trip_metrics(
+        ["42.40", "42.40", "", "0", "42.40"], ["-71.05", "-71.05", "-71.05", "0", "-71.05"],
+        [42.41, 42.40, 42.40, 42.40, 42.40], [-71.05, -71.05, -71.05, -71.05, -71.05], ["600", 0, 600, 600, None])
+
+    assert meters == [pytest.approx(1112.0, abs=0.1), 0.0, None, None, 0.0]
+    assert speeds == [pytest.approx(6.67, abs=0.01), None, None, None, None]
+    assert bad == [0, 0, 1, 1, 0]
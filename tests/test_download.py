@@ -0,0 +1,88 @@
+import os
+import zipfile
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from bluebikes import download
+from bluebikes import sources
+
+
+def test_trip_csvs_of_archives_are_recorded_in_listing(tmp_path, csv_dir):
+    zip_path = tmp_path / "202404-bluebikes-tripdata.zip"
+    with zipfile.ZipFile(zip_path, "w") as zip_ref:
+        zip_ref.write(os.path.join(csv_dir, "202404_new_format_tripdata.csv"), "202404-bluebikes-tripdata.csv")
+        zip_ref.writestr("__MACOSX/._202404-bluebikes-tripdata.csv", "")
+
+    members = [source.src_file for source in sources.archive_sources(str(zip_path), str(tmp_path))]
+    assert members == [os.path.join(str(tmp_path), "202404-bluebikes-tripdata.csv")]
+
+    download._write_listing(str(tmp_path), [("202404-bluebikes-tripdata.zip", 10, "etag")], [members])
+    assert download.read_listing(str(tmp_path)) == {
+        "202404-bluebikes-tripdata.zip": {"size": 10, "etag": "etag", "members": members}
+    }
+
+
+@pytest.fixture(scope="function")
+def local_bucket(tmp_path, csv_dir):
+    bucket_dir = tmp_path / "bucket"
+    bucket_dir.mkdir()
+    with zipfile.ZipFile(bucket_dir / "202404-bluebikes-tripdata.zip", "w") as zip_ref:
+        zip_ref.write(os.path.join(csv_dir, "202404_new_format_tripdata.csv"), "202404-bluebikes-tripdata.csv")
+    (bucket_dir / "index.html").write_text("<html></html>")
+    return download.LocalBucket(str(bucket_dir))
+
+
+def test_download_files_from_local_bucket(tmp_path, local_bucket):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    download.download_files(str(data_dir), bucket=local_bucket, threads=2)
+
+    for key, size, _ in download.list_bucket(local_bucket):
+        assert (data_dir / key).read_bytes() == (tmp_path / "bucket" / key).read_bytes()
+    assert list(download.read_listing(str(data_dir))) == ["202404-bluebikes-tripdata.zip"]
+
+
+def test_download_files_validates_cache_by_etag(tmp_path, local_bucket):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    download.download_files(str(data_dir), bucket=local_bucket)
+    # same size, different contents
+    (tmp_path / "bucket" / "index.html").write_text("<HTML></HTML>")
+    modified = (data_dir / "202404-bluebikes-tripdata.zip").stat().st_mtime_ns
+
+    download.download_files(str(data_dir), bucket=local_bucket)
+    assert (data_dir / "index.html").read_text() == "<HTML></HTML>"
+    assert (data_dir / "202404-bluebikes-tripdata.zip").stat().st_mtime_ns == modified
+
+
+def test_download_file_resumes_partial_download(tmp_path, local_bucket):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    key, size, etag = [o for o in download.list_bucket(local_bucket) if o[0].endswith(".zip")][0]
+    contents = (tmp_path / "bucket" / key).read_bytes()
+    partial = download._partial_path(str(data_dir / key), etag)
+    with open(partial, "wb") as f:
+        f.write(contents[:size // 2])
+    stale = download._partial_path(str(data_dir / key), "old-etag")
+    open(stale, "wb").close()
+
+    download._download_file((key, size, etag), str(data_dir), local_bucket, {})
+    assert (data_dir / key).read_bytes() == contents
+    assert not os.path.exists(partial) and not os.path.exists(stale)
+    assert download._cached_etags(str(data_dir)) == {key: etag}
+
+
+def test_s3_bucket_lists_every_page():
+    s3_client = boto3.client("s3", config=download.boto_config)
+    pages = [
+        {"IsTruncated": True, "NextContinuationToken": "next",
+         "Contents": [{"Key": "a.zip", "Size": 1, "ETag": '"etag-a"'}]},
+        {"IsTruncated": False, "Contents": [{"Key": "b.zip", "Size": 2, "ETag": '"etag-b"'}]},
+    ]
+    with Stubber(s3_client) as stubber:
+        stubber.add_response("list_objects_v2", pages[0], {"Bucket": "bucket"})
+        stubber.add_response("list_objects_v2", pages[1], {"Bucket": "bucket", "ContinuationToken": "next"})
+        objects = download.list_bucket(download.S3Bucket("bucket", s3_client))
+    assert objects == [("a.zip", 1, "etag-a"), ("b.zip", 2, "etag-b")]
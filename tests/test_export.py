@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from bluebikes import export
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def test_export_parquet_partitions_by_month(tmp_path, csv_dir):
+    files = [os.path.join(csv_dir, "201501_old_format_tripdata.csv"),
+             os.path.join(csv_dir, "202404_new_format_tripdata.csv")]
+    export.export_parquet(files, str(tmp_path), num_workers=1)
+
+    old_format = pq.read_table(tmp_path / "year=2015" / "month=01" / "201501_old_format_tripdata.parquet")
+    new_format = pq.read_table(tmp_path / "year=2024" / "month=04" / "202404_new_format_tripdata.parquet")
+
+    assert old_format.schema == new_format.schema
+    assert str(old_format.schema.field("started_at").type) == "timestamp[us]"
+    old_row = old_format.to_pylist()[0]
+    assert old_row["tripduration"] == 542.0
+    assert old_row["birth_year"] == 1984
+    assert old_row["rideable_type"] is None
+    new_row = new_format.to_pylist()[0]
+    assert new_row["tripduration"] == 8207.0
+    assert new_row["start_id"] == "V32003"
+    assert new_row["end_lat"] == 42.403369462300134
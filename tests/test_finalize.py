@@ -0,0 +1,50 @@
+import glob
+import os
+import sqlite3
+
+import pytest
+
+import bluebikes.insert
+from bluebikes import finalize
+
+
+def test_finalize_builds_indexes(tmp_path, csv_dir):
+    database = tmp_path / "test.db"
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    bluebikes.insert.stream_insert_csvs(files, database, num_workers=1)
+
+    finalize.finalize(database, ["started_at", "src_file"])
+
+    with sqlite3.connect(database) as conn:
+        indexes = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' ORDER BY 1")]
+        assert "bluebikes_started_at" in indexes
+        assert "bluebikes_src_file" in indexes
+        assert "bluebikes_start_id" not in indexes
+        plan = list(conn.execute("EXPLAIN QUERY PLAN SELECT COUNT(*) FROM bluebikes WHERE started_at > '2024'"))
+        assert "COVERING INDEX bluebikes_started_at" in plan[0][3]
+
+
+@pytest.mark.parametrize("layout", ["wide", "normalized"])
+def test_calendar_columns_are_indexed(tmp_path, csv_dir, layout):
+    database = tmp_path / "test.db"
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    # memory workers copy their rows to the file database
+    if layout == "wide":
+        bluebikes.insert.memory_insert_csvs(files, database, num_workers=1)
+    else:
+        bluebikes.insert.stream_insert_csvs(files, database, num_workers=1, layout=layout)
+
+    finalize.finalize(database, ["started_at_epoch", "calendar"], layout)
+
+    with sqlite3.connect(database) as conn:
+        trips = list(conn.execute("SELECT started_at, started_at_epoch, start_year, start_month, start_dow, start_hour "
+                                  "FROM bluebikes ORDER BY started_at_epoch"))
+        # a Thursday and a Tuesday
+        assert trips == [("2015-01-01 00:21:44", 1420071704, 2015, 1, 4, 0),
+                         ("2024-04-30 16:56:01", 1714496161, 2024, 4, 2, 16)]
+        plan = list(conn.execute("EXPLAIN QUERY PLAN SELECT COUNT(*) FROM bluebikes "
+                                 "WHERE start_year = 2024 AND start_month = 4"))
+        assert "_calendar" in plan[-1][3]
+        plan = list(conn.execute("EXPLAIN QUERY PLAN SELECT COUNT(*) FROM bluebikes "
+                                 "WHERE started_at_epoch BETWEEN 1714000000 AND 1715000000"))
+        assert "_started_at_epoch" in plan[-1][3]
@@ -5,6 +5,7 @@ import pytest
 import sqlite3
 
 import bluebikes.insert
+import bluebikes.sources
 import bluebikes.sql
 
 
@@ -30,4 +31,243 @@ def test_insert_rows_from_list_of_csvs(empty_test_db, csv_dir):
 
     with sqlite3.connect(empty_test_db) as conn: 
         result = list(conn.execute("SELECT COUNT(*) FROM bluebikes"))
-        assert result==[(2,)]
\ No newline at end of file
+        assert result==[(2,)]
+
+def test_insert_rows_from_list_of_csvs_replaces_reloaded_files(empty_test_db, csv_dir):
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    file_metadata = {f: ("%s.zip" % f, 10, "etag") for f in files}
+    bluebikes.insert.insert_rows_from_list_of_csvs((0, files), empty_test_db, file_metadata)
+    id_offset = bluebikes.insert.max_id(empty_test_db)
+    bluebikes.insert.insert_rows_from_list_of_csvs((0, files[:1]), empty_test_db, file_metadata, id_offset)
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT COUNT(*) FROM bluebikes")) == [(2,)]
+        manifest = list(conn.execute("SELECT src_file, s3_etag, row_count FROM bluebikes_manifest ORDER BY 1"))
+        assert manifest == [(f, "etag", 1) for f in sorted(files)]
+
+    assert bluebikes.insert.load_manifest(empty_test_db) == {f: ("%s.zip" % f, 10, "etag") for f in files}
+
+
+def test_stream_insert_csvs(empty_test_db, csv_dir):
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    bluebikes.insert.stream_insert_csvs(files, empty_test_db, num_workers=2, queue_depth=1)
+    # a second run replaces the rows of the files it reloads
+    bluebikes.insert.stream_insert_csvs(files, empty_test_db, num_workers=1)
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT COUNT(*) FROM bluebikes")) == [(2,)]
+        assert list(conn.execute("SELECT SUM(row_count) FROM bluebikes_manifest")) == [(2,)]
+        assert list(conn.execute("SELECT SUM(row_count) FROM bluebikes_load_stats")) == [(2,)]
+
+
+def test_stream_insert_csvs_normalized_layout_matches_wide(tmp_path, empty_test_db, csv_dir):
+    files = sorted(glob.glob(os.path.join(csv_dir, "*.csv")))
+    normalized_db = tmp_path / "normalized.db"
+    bluebikes.insert.stream_insert_csvs(files, empty_test_db, num_workers=1)
+    bluebikes.insert.stream_insert_csvs(files, normalized_db, num_workers=1, layout="normalized")
+    # reloading reuses the existing dimension rows
+    bluebikes.insert.stream_insert_csvs(files, normalized_db, num_workers=1, layout="normalized")
+
+    query = "SELECT * FROM bluebikes ORDER BY src_file"
+    with sqlite3.connect(empty_test_db) as wide, sqlite3.connect(normalized_db) as normalized:
+        wide_rows = [row[1:] for row in wide.execute(query)]
+        assert [row[1:] for row in normalized.execute(query)] == wide_rows
+        assert list(normalized.execute("SELECT COUNT(*) FROM bluebikes_stations")) == [(4,)]
+
+
+def test_memory_insert_csvs_records_load_stats(empty_test_db, csv_dir):
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    bluebikes.insert.memory_insert_csvs(files, empty_test_db, num_workers=2)
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT COUNT(*), COUNT(DISTINCT id) FROM bluebikes")) == [(2, 2)]
+        stats = list(conn.execute("SELECT src_file, size, row_count FROM bluebikes_load_stats ORDER BY 1"))
+    assert stats == [(f, os.path.getsize(f), 1) for f in sorted(files)]
+
+
+def test_memory_worker_budget():
+    # 2GB fits every worker of an 8 core machine, each keeping 192MB of rows in memory
+    assert bluebikes.insert.memory_worker_budget(2048, 8) == (8, 192 * 1024 * 1024)
+    # 512MB only admits 4 of them
+    assert bluebikes.insert.memory_worker_budget(512, 8) == (4, 64 * 1024 * 1024)
+    # a single worker always runs
+    assert bluebikes.insert.memory_worker_budget(16, 8) == (1, 1024 * 1024)
+
+
+def test_stream_worker_budget():
+    assert bluebikes.insert.stream_worker_budget(4096, 8) == (8, bluebikes.insert.STREAM_QUEUE_DEPTH)
+    # half of the budget goes to the queue, the rest is shared by the writer and the parsers
+    assert bluebikes.insert.stream_worker_budget(64, 8) == (1, 32)
+    assert bluebikes.insert.stream_worker_budget(512, 8) == (6, 64)
+
+
+def test_memory_insert_csvs_spills_to_disk(empty_test_db, csv_dir, tmp_path):
+    with open(os.path.join(csv_dir, "202404_new_format_tripdata.csv")) as f:
+        header, row = f.readlines()
+    large_file = tmp_path / "202404-bluebikes-tripdata.csv"
+    # ride ids are unique
+    rows = [row.strip().replace("399F3B5640FA95C7", "%016X" % i) + "\n" for i in range(5000)]
+    large_file.write_text(header + "".join(rows))
+
+    # far less than the rows take, so the worker's database is spilled to a temporary file
+    bluebikes.insert.memory_insert_csvs([str(large_file)], empty_test_db, num_workers=1, max_database_bytes=1024)
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT COUNT(*), COUNT(DISTINCT id) FROM bluebikes")) == [(5000, 5000)]
+
+
+def test_shard_insert_csvs_merges_in_time_order(empty_test_db, csv_dir):
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    worker_stats = bluebikes.insert.shard_insert_csvs(files, empty_test_db, num_workers=2)
+
+    with sqlite3.connect(empty_test_db) as conn:
+        rows = list(conn.execute("SELECT id, src_file FROM bluebikes ORDER BY started_at"))
+        manifest = list(conn.execute("SELECT src_file, row_count FROM bluebikes_manifest ORDER BY 1"))
+    # ids follow the start time across the shards
+    assert [id for id, _ in rows] == [1, 2]
+    assert [src_file for _, src_file in rows] == sorted(files)
+    assert manifest == [(f, 1) for f in sorted(files)]
+    assert sorted(s['worker'] for s in worker_stats) == ['merge-0', 'shard-0', 'shard-1']
+    assert not glob.glob(str(empty_test_db) + ".shard-*")
+
+
+def test_merge_shards_replaces_files_and_folds_extra_shards(empty_test_db, csv_dir, tmp_path, monkeypatch):
+    files = sorted(glob.glob(os.path.join(csv_dir, "*.csv")))
+    bluebikes.insert.memory_insert_csvs(files, empty_test_db, num_workers=1)
+    # one shard per file, more than can be attached at once
+    monkeypatch.setattr(bluebikes.insert, "MAX_ATTACHED_SHARDS", 1)
+    shards = []
+    for n, f in enumerate(files):
+        memory_conn, cursor = bluebikes.insert._initialize_in_memory_database(n)
+        bluebikes.insert._insert_rows_from_single_csv(bluebikes.sources.as_source(f), cursor)
+        shards.append(str(tmp_path / ("shard-%s" % n)))
+        bluebikes.insert._write_shard(memory_conn, shards[-1], [(f, os.path.getsize(f), 1, 0.1)])
+
+    bluebikes.insert.merge_shards(shards, empty_test_db)
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT src_file, COUNT(*) FROM bluebikes GROUP BY 1")) == [(f, 1) for f in files]
+    assert not os.path.exists(shards[1])
+
+
+def test_memory_insert_csvs_checkpoints(empty_test_db, csv_dir, monkeypatch):
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    # every file is copied into the file database as soon as it is loaded
+    monkeypatch.setattr(bluebikes.insert, "CHECKPOINT_SIZE", 1)
+    bluebikes.insert.memory_insert_csvs(files, empty_test_db, num_workers=1)
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT COUNT(*), COUNT(DISTINCT id) FROM bluebikes")) == [(2, 2)]
+        assert list(conn.execute("SELECT COUNT(*) FROM bluebikes_manifest")) == [(2,)]
+
+
+def test_delete_partial_files(empty_test_db, csv_dir):
+    old_file, new_file = sorted(glob.glob(os.path.join(csv_dir, "*.csv")))
+    bluebikes.insert.memory_insert_csvs([old_file, new_file], empty_test_db, num_workers=1)
+    with sqlite3.connect(empty_test_db) as conn:
+        # an interrupted stream writer committed the rows of a file without its manifest entry
+        conn.execute("DELETE FROM bluebikes_manifest WHERE src_file = ?", [new_file])
+
+    assert bluebikes.insert.delete_partial_files(empty_test_db) == [new_file]
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT src_file FROM bluebikes")) == [(old_file,)]
+    assert bluebikes.insert.delete_partial_files(empty_test_db) == []
+
+
+def _write_csv_with_bad_rows(csv_dir, path, rows, bad_rows):
+    with open(os.path.join(csv_dir, "202404_new_format_tripdata.csv")) as f:
+        header, row = f.read().splitlines()
+    lines = []
+    for i in range(rows):
+        line = row.replace("399F3B5640FA95C7", "%016X" % i)
+        if i in bad_rows:
+            # no start time, so no trip duration for the NOT NULL column
+            line = line.replace('"2024-04-30 16:56:01"', '""')
+        lines.append(line + "\n")
+    path.write_text(header + "\n" + "".join(lines))
+    return str(path)
+
+
+@pytest.mark.parametrize("strategy", ["memory", "stream"])
+def test_bad_rows_are_rejected_without_their_batch(empty_test_db, csv_dir, tmp_path, strategy):
+    # the second line of the file is the first row
+    csv_file = _write_csv_with_bad_rows(csv_dir, tmp_path / "202404-bluebikes-tripdata.csv", 2500, {1, 1500})
+    if strategy == "memory":
+        worker_stats = bluebikes.insert.memory_insert_csvs([csv_file], empty_test_db, num_workers=1)
+    else:
+        worker_stats = bluebikes.insert.stream_insert_csvs([csv_file], empty_test_db, num_workers=1)
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT COUNT(*) FROM bluebikes")) == [(2498,)]
+        assert list(conn.execute("SELECT row_count FROM bluebikes_manifest")) == [(2498,)]
+        rejected = list(conn.execute("SELECT src_file, start, line, error FROM bluebikes_rejected_rows ORDER BY 3"))
+    assert rejected == [(csv_file, 0, 3, "NOT NULL constraint failed: bluebikes.tripduration"),
+                        (csv_file, 0, 1502, "NOT NULL constraint failed: bluebikes.tripduration")]
+    assert sum(stats['rejected_rows'] for stats in worker_stats) == 2
+
+
+def test_bulk_insert_bisects_failing_batches():
+    memory_conn, cursor = bluebikes.insert._initialize_in_memory_database(0)
+    columns = ("src_file", "tripduration", "started_at", "ended_at", "start_id", "start_station_name", "start_lat",
+               "start_lng", "end_id", "end_station_name", "end_lat", "end_lng", "ride_id", "usertype")
+    good = ("f", 60, "a", "b", 1, "s", 1.0, 1.0, 2, "e", 1.0, 1.0, 1, "member")
+    batch = [good] * 10
+    batch[0] = batch[7] = batch[8] = good[:1] + (None,) + good[2:]
+    rejects = []
+
+    assert bluebikes.insert._bulk_insert(batch, bluebikes.sql.insert_stmt(columns), cursor, rejects) == 7
+    assert [index for index, _ in rejects] == [0, 7, 8]
+    assert list(memory_conn.execute("SELECT COUNT(*) FROM bluebikes")) == [(7,)]
+
+
+def test_arrow_parser_matches_csv_parser(csv_dir, tmp_path):
+    pytest.importorskip("pyarrow.csv")
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    files.append(_write_csv_with_bad_rows(csv_dir, tmp_path / "202404-bluebikes-tripdata.csv", 2500, set()))
+    for source in map(bluebikes.sources.as_source, files):
+        expected = list(bluebikes.insert.read_batches(source, with_lines=True))
+        assert list(bluebikes.insert.read_batches(source, with_lines=True, csv_parser="arrow")) == expected
+
+    # quoted newlines inside a field, split into chunks that carry the header
+    with open(os.path.join(csv_dir, "202404_new_format_tripdata.csv")) as f:
+        header, row = f.read().splitlines()
+    multiline = tmp_path / "202405-bluebikes-tripdata.csv"
+    multiline.write_text(header + "\n" + "".join(
+        row.replace("399F3B5640FA95C7", str(i)).replace('"Chelsea St', '"Line\nbreak %s' % i) + "\n"
+        for i in range(300)))
+    chunks = bluebikes.sources.split_source(bluebikes.sources.as_source(str(multiline)), 2048)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        # line numbers differ once fields span lines
+        assert list(bluebikes.insert.read_batches(chunk, csv_parser="arrow")) == list(
+            bluebikes.insert.read_batches(chunk))
+
+
+def test_stream_insert_csvs_with_arrow_parser(empty_test_db, csv_dir):
+    pytest.importorskip("pyarrow.csv")
+    files = glob.glob(os.path.join(csv_dir, "*.csv"))
+    bluebikes.insert.stream_insert_csvs(files, empty_test_db, num_workers=1, csv_parser="arrow")
+
+    with sqlite3.connect(empty_test_db) as conn:
+        assert list(conn.execute("SELECT COUNT(*) FROM bluebikes")) == [(2,)]
+
+
+@pytest.mark.parametrize("layout", ["wide", "normalized"])
+def test_create_tables_adds_derived_columns_to_existing_tables(tmp_path, csv_dir, layout):
+    database = str(tmp_path / "test.db")
+    table = "bluebikes_trips" if layout == "normalized" else "bluebikes"
+    with sqlite3.connect(database) as conn:
+        bluebikes.insert.create_tables(conn, layout)
+        # the tables of a database created before the derived columns
+        if layout == "normalized":
+            conn.execute("DROP VIEW bluebikes")
+        for name, _ in reversed(bluebikes.sql.derived_columns):
+            conn.execute("ALTER TABLE %s DROP COLUMN %s" % (table, name))
+
+    bluebikes.insert.stream_insert_csvs(glob.glob(os.path.join(csv_dir, "*.csv")), database, num_workers=1,
+                                        layout=layout)
+
+    with sqlite3.connect(database) as conn:
+        assert list(conn.execute("SELECT COUNT(distance_meters), SUM(bad_coordinates), MIN(start_year) "
+                                 "FROM bluebikes")) == [(2, 0, 2015)]
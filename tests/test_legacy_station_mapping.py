@@ -1,4 +1,6 @@
 import os
+import random
+
 from bluebikes.stations.legacy import mapping
 
 
@@ -20,3 +22,26 @@ def test_insert_rows_from_list_of_csvs(legacy_stations_dir):
     }
 
     assert mappings == expected_mappings
+
+
+def _point(lat, lng):
+    return lat, (lng + 180) % 360 - 180
+
+
+def test_station_grid_finds_the_closest_station_within_max_distance():
+    rng = random.Random(0)
+    # around Boston, the antimeridian and a pole
+    centers = [(42.36, -71.08), (0.0, 179.9999), (89.997, 0.0)]
+    stations = [_point(lat + rng.uniform(-0.002, 0.002), lng + rng.uniform(-0.002, 0.002))
+                for lat, lng in centers for _ in range(200)]
+    # an exact duplicate is a tie, the first one wins
+    stations.append(stations[3])
+    ids = ["S%s" % i for i in range(len(stations))]
+    grid = mapping.StationGrid(ids, [lat for lat, _ in stations], [lng for _, lng in stations], 25)
+
+    for lat, lng in stations[:20] + [_point(lat + 0.0001, lng - 0.0001) for lat, lng in stations[::7]]:
+        distances = [mapping.calculate_distance(lat, lng, *station) for station in stations]
+        closest = min(range(len(stations)), key=lambda i: distances[i])
+        expected = (ids[closest], distances[closest]) if distances[closest] <= 25 else (None, float('inf'))
+        assert grid.closest(lat, lng) == expected
+    assert grid.closest(float('nan'), 0.0) == (None, float('inf'))
@@ -0,0 +1,16 @@
+from bluebikes.main import changed_s3_objects
+
+
+def test_changed_s3_objects():
+    manifest = {
+        'data/202401-bluebikes-tripdata.csv': ('202401-bluebikes-tripdata.zip', 10, 'a'),
+        'data/202402-bluebikes-tripdata.csv': ('202402-bluebikes-tripdata.zip', 10, 'b'),
+    }
+    s3_files = [
+        ('202401-bluebikes-tripdata.zip', 10, 'a'),  # unchanged
+        ('202402-bluebikes-tripdata.zip', 12, 'c'),  # republished
+        ('202403-bluebikes-tripdata.zip', 10, 'd'),  # new month
+        ('current_bluebikes_stations.csv', 10, 'e'),  # not a trip archive
+    ]
+
+    assert changed_s3_objects(s3_files, manifest) == s3_files[1:3]
@@ -0,0 +1,61 @@
+import json
+import os
+import pstats
+
+from bluebikes.metrics import RunReport, WorkerStats, profiled
+
+
+def _worker(role, number, files):
+    stats = WorkerStats(role, number)
+    for src_file, rows, size, seconds in files:
+        stats.add_file(src_file, rows, size, seconds)
+    return stats.as_dict()
+
+
+def test_run_report_aggregates_chunks_of_a_file(tmp_path):
+    report = RunReport()
+    with report.stage('insert', files=2) as stage:
+        stage['bytes'] = 300
+    # the first file was split into chunks parsed by two workers
+    report.add_workers([
+        _worker('parser', 0, [("a.csv", 10, 100, 1.0), ("b.csv", 5, 100, 0.5)]),
+        _worker('parser', 1, [("a.csv", 30, 100, 1.0)]),
+    ])
+    path = str(tmp_path / "report.json")
+    report.write(path)
+    with open(path) as f:
+        result = json.load(f)
+
+    assert [(s['name'], s['files'], s['bytes']) for s in result['stages']] == [('insert', 2, 300)]
+    assert result['stages'][0]['seconds'] >= 0
+    assert [w['worker'] for w in result['workers']] == ['parser-0', 'parser-1']
+    assert result['workers'][0]['rows'] == 15
+    assert result['files'][0] == {'src_file': "a.csv", 'rows': 40, 'bytes': 200, 'seconds': 2.0, 'rejected_rows': 0,
+                                  'workers': ['parser-0', 'parser-1'], 'rows_per_sec': 20.0}
+
+
+def test_worker_stats_counts_rejected_rows_and_lock_wait():
+    stats = WorkerStats('writer')
+    stats.add_batch(100, 100)
+    stats.add_batch(100, 97)
+    with stats.waiting_for_lock():
+        pass
+
+    result = stats.as_dict()
+    assert result['rejected_rows'] == 3
+    assert result['lock_wait_seconds'] >= 0
+    assert result['peak_rss_mb'] > 0
+
+
+def test_profiled_writes_pstats(tmp_path):
+    with profiled(str(tmp_path), 'writer'):
+        sum(range(1000))
+
+    path = os.path.join(str(tmp_path), 'writer-%s.pstats' % os.getpid())
+    assert pstats.Stats(path).total_calls > 0
+
+
+def test_profiled_without_directory_does_nothing(tmp_path):
+    with profiled(None, 'writer'):
+        pass
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import zipfile
+
+import pytest
+
+from bluebikes import download
+from bluebikes import pipeline
+
+
+def test_download_and_insert(tmp_path, csv_dir):
+    bucket_dir = tmp_path / "bucket"
+    bucket_dir.mkdir()
+    for name in os.listdir(csv_dir):
+        with zipfile.ZipFile(bucket_dir / name.replace(".csv", ".zip"), "w") as zip_ref:
+            zip_ref.write(os.path.join(csv_dir, name), name)
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    database = str(tmp_path / "test.db")
+    bucket = download.LocalBucket(str(bucket_dir))
+
+    loaded, worker_stats = pipeline.download_and_insert(str(data_dir), download.list_bucket(bucket), bucket, database,
+                                                        num_parsers=2, threads=2, queue_depth=1)
+
+    assert sorted(source.src_file for source in loaded) == sorted(str(data_dir / name) for name in os.listdir(csv_dir))
+    with sqlite3.connect(database) as conn:
+        assert list(conn.execute("SELECT COUNT(*) FROM bluebikes")) == [(2,)]
+        manifest = list(conn.execute("SELECT s3_key, row_count FROM bluebikes_manifest ORDER BY 1"))
+    assert [stats["worker"] for stats in worker_stats][-1] == "writer-0"
+    assert sum(stats["rows"] for stats in worker_stats[:-1]) == 2
+    assert manifest == [(name.replace(".csv", ".zip"), 1) for name in sorted(os.listdir(csv_dir))]
+
+
+def test_download_and_insert_raises_download_errors(tmp_path):
+    bucket = download.LocalBucket(str(tmp_path))
+    database = str(tmp_path / "test.db")
+
+    # the parsers and the writer still shut down when a download fails
+    with pytest.raises(FileNotFoundError):
+        pipeline.download_and_insert(str(tmp_path), [("missing.zip", 1, "etag")], bucket, database, num_parsers=1)
@@ -0,0 +1,27 @@
+import glob
+import os
+import sqlite3
+
+import bluebikes.insert
+from bluebikes import rollups
+
+
+def test_refresh_rollups(tmp_path, csv_dir):
+    database = tmp_path / "test.db"
+    files = sorted(glob.glob(os.path.join(csv_dir, "*.csv")))
+    bluebikes.insert.stream_insert_csvs(files, database, num_workers=1)
+
+    rollups.refresh_rollups(database, files)
+    # refreshing a file replaces its rollups rather than adding to them
+    rollups.refresh_rollups(database, files[1:])
+
+    with sqlite3.connect(database) as conn:
+        hourly = list(conn.execute("SELECT station_id, hour, departures, arrivals FROM bluebikes_station_hourly "
+                                   "ORDER BY hour, station_id"))
+        assert hourly == [(96, "2015-01-01 00", 0, 1), (115, "2015-01-01 00", 1, 0),
+                          ("V32003", "2024-04-30 16", 1, 0), ("V32016", "2024-04-30 19", 0, 1)]
+        daily = list(conn.execute("SELECT SUM(departures), SUM(arrivals) FROM bluebikes_station_daily"))
+        assert daily == [(2, 2)]
+        od = list(conn.execute("SELECT month, start_id, end_id, trips, avg_tripduration FROM bluebikes_od_monthly "
+                               "ORDER BY month"))
+        assert od == [("2015-01", 115, 96, 1, 542.0), ("2024-04", "V32003", "V32016", 1, 8207.0)]
@@ -0,0 +1,24 @@
+from bluebikes.scheduler import order_by_cost
+from bluebikes.sources import TripSource
+
+
+def _source(name, size):
+    return TripSource(name, None, None, size)
+
+
+def test_order_by_cost_without_stats_is_largest_first():
+    sources = [_source("a", 10), _source("b", 30), _source("c", 20)]
+    assert [s.src_file for s in order_by_cost(sources)] == ["b", "c", "a"]
+
+
+def test_order_by_cost_uses_measured_seconds():
+    sources = [_source("v0", 100), _source("v2", 50), _source("new", 60)]
+    # v2 is smaller but was slower, new is estimated at the median rate of 0.025 seconds per byte
+    load_stats = {"v0": (100, 1.0), "v2": (50, 2.0)}
+    assert [s.src_file for s in order_by_cost(sources, load_stats)] == ["v2", "new", "v0"]
+
+
+def test_order_by_cost_ignores_stats_of_changed_files():
+    sources = [_source("a", 100), _source("b", 50)]
+    load_stats = {"a": (100, 1.0), "b": (10, 10.0)}
+    assert [s.src_file for s in order_by_cost(sources, load_stats)] == ["b", "a"]
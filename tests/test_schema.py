@@ -0,0 +1,55 @@
+import pytest
+
+from bluebikes import schema
+
+V0_HEADER = ["tripduration", "starttime", "stoptime", "start station id", "start station name",
+             "start station latitude", "start station longitude", "end station id", "end station name",
+             "end station latitude", "end station longitude", "bikeid", "usertype", "birth year", "gender"]
+V2_HEADER = ["ride_id", "rideable_type", "started_at", "ended_at", "start_station_name", "start_station_id",
+             "end_station_name", "end_station_id", "start_lat", "start_lng", "end_lat", "end_lng", "member_casual"]
+
+
+def test_adapter_keeps_columns_of_layouts_with_duration():
+    adapter = schema.adapter_for_header(V0_HEADER, "201501.csv")
+    row = ["542", "2015-01-01 00:21:44", "2015-01-01 00:30:47", "115", "Porter Square Station", "42.38", "-71.11",
+           "96", "Cambridge Main Library", "42.37", "-71.11", "277", "Subscriber", "1984", "1"]
+
+    assert adapter.columns[:4] == ("src_file", "tripduration", "started_at", "ended_at")
+    assert adapter.columns[-5:] == ("distance_meters", "speed_kmh", "bad_coordinates", "started_at_epoch",
+                                    "ended_at_epoch")
+    [adapted] = adapter.adapt([row])
+    assert adapted[:-5] == ("201501.csv", *row)
+    # 0.01 degrees of latitude in 542s
+    assert adapted[-5:] == (pytest.approx(1112.0, abs=0.1), pytest.approx(7.39, abs=0.01), 0, 1420071704, 1420072247)
+
+
+def test_adapter_derives_duration_from_header_positions():
+    # the column order comes from the header, not from the date of the file
+    header = ["\ufeffride_id"] + V2_HEADER[1:]
+    adapter = schema.adapter_for_header(header, "202404.csv")
+    row = ["399F3B5640FA95C7", "classic_bike", "2024-04-30 16:56:01", "2024-04-30 19:12:48", "Everett Square",
+           "V32003", "Chelsea St at Vine St", "V32016", "42.40", "-71.05", "42.40", "-71.04", "casual"]
+
+    assert adapter.columns[:4] == ("src_file", "tripduration", "ride_id", "rideable_type")
+    [adapted] = adapter.adapt([row])
+    assert adapted[:-5] == ("202404.csv", 8207.0, *row)
+    assert adapted[-5:] == (pytest.approx(821.1, abs=0.1), pytest.approx(0.36, abs=0.01), 0, 1714496161, 1714504368)
+
+
+def test_adapter_flags_bad_coordinates():
+    adapter = schema.adapter_for_header(V2_HEADER, "202404.csv")
+    row = ["399F3B5640FA95C7", "classic_bike", "2024-04-30 16:56:01", "2024-04-30 16:56:01", "Everett Square",
+           "V32003", "Chelsea St at Vine St", "V32016", "42.40", "-71.05", "42.40", "-71.04", "casual"]
+    # no end coordinates, the 0,0 placeholder, a latitude out of range, and a valid trip of no duration
+    rows = [row[:10] + ["", ""] + row[12:], row[:8] + ["0", "0"] + row[10:], row[:8] + ["142.4"] + row[9:], row]
+
+    derived = [adapted[-5:-2] for adapted in adapter.adapt(rows)]
+    assert derived[:3] == [(None, None, 1)] * 3
+    assert derived[3] == (pytest.approx(821.1, abs=0.1), None, 0)
+    columns = {i: list(values) for i, values in enumerate(zip(*rows))}
+    assert adapter.adapt_columns(columns, len(rows)) == adapter.adapt(rows)
+
+
+def test_adapter_rejects_unknown_layout():
+    with pytest.raises(ValueError):
+        schema.adapter_for_header(V2_HEADER[:-1], "202404.csv")
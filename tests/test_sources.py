@@ -0,0 +1,118 @@
+import csv
+import os
+import shutil
+import sqlite3
+import zipfile
+
+import bluebikes.insert
+import bluebikes.sql
+from bluebikes import sources
+
+
+def _zip_csv(csv_dir, data_dir, name):
+    zip_path = os.path.join(data_dir, name.replace(".csv", ".zip"))
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.write(os.path.join(csv_dir, name), name)
+        zip_ref.writestr("__MACOSX/._%s" % name, "")
+    return zip_path
+
+
+def test_find_sources_reads_archive_members_without_extracting(tmp_path, csv_dir):
+    data_dir = str(tmp_path)
+    zip_path = _zip_csv(csv_dir, data_dir, "202404_new_format_tripdata.csv")
+    shutil.copy(os.path.join(csv_dir, "201501_old_format_tripdata.csv"), data_dir)
+
+    found = sorted(sources.find_sources(data_dir))
+    assert [source.src_file for source in found] == [
+        os.path.join(data_dir, "201501_old_format_tripdata.csv"),
+        os.path.join(data_dir, "202404_new_format_tripdata.csv"),
+    ]
+    assert found[0].archive is None
+    assert found[1].archive == zip_path
+    assert found[1].size == os.path.getsize(os.path.join(csv_dir, "202404_new_format_tripdata.csv"))
+    assert not os.path.exists(found[1].src_file)
+
+    with sources.open_source(found[1]) as member:
+        with open(os.path.join(csv_dir, "202404_new_format_tripdata.csv"), newline='') as extracted:
+            assert member.read() == extracted.read()
+
+
+def test_insert_from_archive(tmp_path, csv_dir):
+    data_dir = str(tmp_path)
+    _zip_csv(csv_dir, data_dir, "202404_new_format_tripdata.csv")
+    database = str(tmp_path / "test.db")
+    with sqlite3.connect(database) as conn:
+        conn.execute(bluebikes.sql.table_create)
+
+    bluebikes.insert.stream_insert_csvs(sources.find_sources(data_dir), database, num_workers=1)
+
+    with sqlite3.connect(database) as conn:
+        assert list(conn.execute("SELECT src_file, COUNT(*) FROM bluebikes GROUP BY 1")) == [
+            (os.path.join(data_dir, "202404_new_format_tripdata.csv"), 1)]
+
+
+def _write_large_csv(csv_dir, path, rows):
+    with open(os.path.join(csv_dir, "202404_new_format_tripdata.csv"), newline='') as f:
+        header, row = list(csv.reader(f))
+    with open(path, "w", newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        for i in range(rows):
+            # station names with quotes and newlines must not be split
+            name = ['Plain St', 'Quoted "Q" St', 'Line\nbreak St', 'Ends with "\n"'][i % 4]
+            writer.writerow([str(i)] + row[1:4] + [name] + row[5:])
+    return path
+
+
+def _read_chunks(chunks):
+    rows = []
+    for chunk in chunks:
+        with sources.open_source(chunk) as f:
+            reader = csv.reader(f)
+            if chunk.header is None:
+                next(reader)
+            rows.extend(reader)
+    return rows
+
+
+def test_split_source_keeps_rows_with_quoted_newlines_whole(tmp_path, csv_dir):
+    path = _write_large_csv(csv_dir, str(tmp_path / "202404-bluebikes-tripdata.csv"), 500)
+    with open(path, newline='') as f:
+        header, *expected = list(csv.reader(f))
+
+    for chunk_size in [1, 100, 4096, 10 ** 9]:
+        chunks = sources.split_source(sources.as_source(path), chunk_size)
+        assert _read_chunks(chunks) == expected
+        assert all(chunk.src_file == path and chunk.chunk_count == len(chunks) for chunk in chunks)
+    assert len(sources.split_source(sources.as_source(path), 4096)) > 1
+    assert sources.split_source(sources.as_source(path), 4096)[1].header == tuple(header)
+
+
+def test_split_source_of_archive_member(tmp_path, csv_dir):
+    path = _write_large_csv(csv_dir, str(tmp_path / "202404-bluebikes-tripdata.csv"), 200)
+    with zipfile.ZipFile(tmp_path / "202404-bluebikes-tripdata.zip", "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.write(path, "202404-bluebikes-tripdata.csv")
+    with open(path, newline='') as f:
+        expected = list(csv.reader(f))[1:]
+    os.remove(path)
+
+    [source] = sources.find_sources(str(tmp_path))
+    chunks = sources.split_source(source, 2048)
+    assert len(chunks) > 1
+    assert _read_chunks(chunks) == expected
+
+
+def test_stream_insert_of_chunks_matches_whole_files(tmp_path, csv_dir):
+    path = _write_large_csv(csv_dir, str(tmp_path / "202404-bluebikes-tripdata.csv"), 300)
+    tables = []
+    for chunk_size in [10 ** 9, 2048]:
+        database = str(tmp_path / ("%s.db" % chunk_size))
+        bluebikes.insert.stream_insert_csvs([path], database, num_workers=2, chunk_size=chunk_size)
+        # a reload replaces every chunk
+        bluebikes.insert.stream_insert_csvs([path], database, num_workers=2, chunk_size=chunk_size)
+        with sqlite3.connect(database) as conn:
+            tables.append(list(conn.execute("SELECT * FROM bluebikes ORDER BY CAST(ride_id AS INTEGER)")))
+            assert list(conn.execute("SELECT row_count FROM bluebikes_manifest")) == [(300,)]
+            assert list(conn.execute("SELECT size FROM bluebikes_load_stats")) == [(os.path.getsize(path),)]
+    columns = slice(1, None)
+    assert [row[columns] for row in tables[0]] == [row[columns] for row in tables[1]]
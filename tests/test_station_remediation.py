@@ -1,3 +1,5 @@
+import pytest
+
 from bluebikes.stations.remediation.conflicts import process
 
 
@@ -32,3 +34,12 @@ def test_published_stations_from_csvs(remedial_stations_input_file):
                 -71.06092190993877, -71.059624, -71.059624, -71.059624]}
 
     assert conflicting_stations == expected_mappings
+
+
+def test_conflicting_stations_with_distances(remedial_stations_input_file):
+    conflicting_stations_df = process(remedial_stations_input_file, with_distances=True)
+
+    by_name = conflicting_stations_df.groupby('station_name')['max_distance_meters'].max()
+    assert by_name['Bremen St at Marion St'] < 1
+    assert by_name['Chelsea St at Vine St'] == pytest.approx(1918.7, abs=0.1)
+    assert list(conflicting_stations_df.columns) == ['station_id', 'station_name', 'lat', 'lng', 'max_distance_meters']
@@ -0,0 +1,19 @@
+from bluebikes import timestamps
+
+
+def test_durations():
+    started_at = ["2024-04-30 16:56:01", "2024-06-01 00:00:00.250", "2024-06-01 10:00:00"]
+    ended_at = ["2024-04-30 19:12:48", "2024-06-01 00:01:00.000", "2024-06-01 10:00:30.5"]
+
+    assert timestamps.durations(started_at, ended_at) == [8207.0, 59.75, 30.5]
+
+
+def test_durations_fall_back_per_value():
+    started_at = ["2024-04-30 16:56:01", "7/28/2011 10:12", "not a date", ""]
+    ended_at = ["2024-04-30 16:57:01", "7/28/2011 10:13:30", "2024-04-30 16:57:01", "2024-04-30 16:57:01"]
+
+    assert timestamps.durations(started_at, ended_at) == [60.0, 90.0, None, None]
+
+
+def test_durations_empty_batch():
+    assert timestamps.durations([], []) == []